@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# keeps copies of the pages that entries of loadlink feeds link to, so that
+# they can be read offline and show up without waiting for the site
+
+from gi.repository import Soup
+from urlparse import urljoin
+from urllib import pathname2url
+from lxml import etree
+import lxml.html
+import collections
+import hashlib
+import mimetypes
+import os
+import re
+import time
+import fetcher
+
+# the names put gives to files, relative to the store
+STORED_NAME = re.compile(r'\b([0-9a-f]{2})/(\1[0-9a-f]{38}(?:\.\w+)?)\b')
+
+
+def extension(content_type, url):
+    """
+    returns the file name extension to store a resource with, webkit uses
+    it to tell the type of the files it loads from the archive
+    """
+    ext = mimetypes.guess_extension((content_type or '').split(';')[0].strip())
+    if not ext:
+        ext = os.path.splitext(url.split('?')[0])[1][:8]
+    # mimetypes likes to pick odd ones
+    return {'.jpe': '.jpg', '.htm': '.html', '.ksh': '.txt'}.get(ext, ext)
+
+def sweep(feeddb, store, grace=60*60):
+    """
+    delete the files in the directory store that neither an archived entry
+    nor the pages of such entries refer to anymore, for example after
+    their entries were pruned. files younger than grace seconds are kept,
+    as they might belong to a page that is still being archived
+    returns the number of deleted files and their size
+    """
+    referenced = set()
+    for name in feeddb.get_archived_all():
+        referenced.add(name)
+        if name.endswith('.html'):
+            try:
+                with open(os.path.join(store, name)) as f:
+                    # the images and stylesheets the page was rewritten to
+                    referenced.update("%s/%s"%match for match in STORED_NAME.findall(f.read()))
+            except IOError:
+                pass
+    deleted = size = 0
+    now = time.time()
+    for directory, dirnames, filenames in os.walk(store):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if os.path.relpath(path, store) in referenced:
+                continue
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime > now - grace:
+                    continue
+                os.remove(path)
+            except OSError:
+                continue
+            deleted += 1
+            size += stat.st_size
+    return deleted, size
+
+class Archiver():
+    """
+    downloads the linked pages of entries together with their images and
+    stylesheets into a content-addressed store below directory store
+    the pages are rewritten to load these from the store, everything else
+    like links keeps pointing to the original site
+    all downloads go through scheduler, which bounds their concurrency
+    """
+    # resources of a page that are stored at most
+    max_resources = 50
+    # larger resources are not stored
+    max_size = 10*1024*1024
+
+    def __init__(self, feeddb, scheduler, store):
+        self.feeddb = feeddb
+        self.scheduler = scheduler
+        self.store = store
+
+    def path(self, feed, entry):
+        """
+        returns the path of the archived copy of the link of entry or None
+        """
+        name = self.feeddb.get_archived(feed, entry)
+        if not name:
+            return None
+        path = os.path.join(self.store, name)
+        if not os.path.isfile(path):
+            return None
+        return path
+
+    def uri(self, name):
+        return "file://" + pathname2url(os.path.join(self.store, name))
+
+    def put(self, data, ext):
+        """
+        store data under its hash and return its path relative to the store
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        name = os.path.join(digest[:2], digest+ext)
+        path = os.path.join(self.store, name)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # write to a temporary file first so that there are no partial files
+            with open(path+".tmp", "wb") as f:
+                f.write(data)
+            os.rename(path+".tmp", path)
+        return name
+
+    def archive(self, feed, entries, callback=None):
+        """
+        archive the linked pages of those entries of feed that are not
+        archived yet and call callback(feed) once all of them are done
+        """
+        pending = [entry for entry in entries if not self.path(feed, entry)]
+        remaining = [len(pending)]
+        def entry_done():
+            remaining[0] -= 1
+            if not remaining[0] and callback:
+                callback(feed)
+        if not pending and callback:
+            callback(feed)
+        for entry in pending:
+            self.archive_entry(feed, entry, entry_done)
+
+    def archive_entry(self, feed, entry, done):
+        link = self.feeddb.get_entry(feed, entry).get('link')
+        msg = Soup.Message.new("GET", link) if link else None
+        if not msg:
+            done()
+            return
+        def complete_cb(session, msg):
+            if msg.status_code != 200:
+                done()
+                return
+            data = msg.response_body.flatten().get_data()
+            content_type = msg.response_headers.get_one('Content-Type') or ''
+            url = msg.get_uri().to_string(False)
+            if 'html' in content_type:
+                self.archive_page(feed, entry, url, data, done)
+            else:
+                # pdfs, images and the like are kept as they are
+                self.feeddb.set_archived(feed, entry, self.put(data, extension(content_type, url)))
+                done()
+        self.scheduler.queue_message(msg, complete_cb, priority=fetcher.PRIORITY_LOW)
+
+    def archive_page(self, feed, entry, url, data, done):
+        """
+        store the images and stylesheets of the html page data downloaded
+        from url and then the page itself
+        """
+        try:
+            doc = lxml.html.document_fromstring(data)
+        except (etree.ParserError, ValueError):
+            done()
+            return
+        head = doc.find('head')
+        if head is None:
+            head = etree.Element('head')
+            doc.insert(0, head)
+        # the archived page is loaded from a file, so relative links have to
+        # be resolved against the original location
+        base = doc.find('.//base[@href]')
+        if base is not None:
+            url = urljoin(url, base.get('href'))
+        else:
+            head.insert(0, etree.Element('base', href=url))
+        # the page is stored as utf-8
+        for meta in doc.iter('meta'):
+            if meta.get('charset') or (meta.get('http-equiv') or '').lower() == 'content-type':
+                meta.getparent().remove(meta)
+        head.insert(0, etree.Element('meta', charset='utf-8'))
+
+        # resource url -> list of (element, attribute) referring to it
+        resources = collections.OrderedDict()
+        for element in doc.iter('img', 'link'):
+            if element.tag == 'img':
+                attribute = 'src'
+                # otherwise webkit might pick one of the other sources
+                element.attrib.pop('srcset', None)
+            elif 'stylesheet' in (element.get('rel') or '').lower().split():
+                attribute = 'href'
+            else:
+                continue
+            if not element.get(attribute):
+                continue
+            resource = urljoin(url, element.get(attribute).strip())
+            if not resource.startswith('http'):
+                continue
+            if resource not in resources and len(resources) >= self.max_resources:
+                continue
+            resources.setdefault(resource, list()).append((element, attribute))
+
+        remaining = [len(resources)]
+        def finish():
+            page = lxml.html.tostring(doc, encoding='utf-8', include_meta_content_type=True)
+            self.feeddb.set_archived(feed, entry, self.put(page, '.html'))
+            done()
+        def resource_done():
+            remaining[0] -= 1
+            if not remaining[0]:
+                finish()
+        def complete_cb(session, msg, users):
+            data = msg.response_body.flatten().get_data()
+            if msg.status_code == 200 and data and len(data) <= self.max_size:
+                name = self.put(data, extension(msg.response_headers.get_one('Content-Type'), msg.get_uri().to_string(False)))
+                for element, attribute in users:
+                    element.set(attribute, self.uri(name))
+            resource_done()
+
+        if not resources:
+            finish()
+        for resource, users in resources.items():
+            msg = Soup.Message.new("GET", resource)
+            if not msg:
+                resource_done()
+                continue
+            self.scheduler.queue_message(msg, complete_cb, users, priority=fetcher.PRIORITY_LOW)
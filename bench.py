@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# benchmarks for the storage, the feed parsers and the gui models on
+# synthetic databases and feeds. the results are written as json so that
+# two runs can be compared with --compare.
+
+from optparse import OptionParser, SUPPRESS_HELP
+import feedworker
+import sqlite_db
+import feedparser
+import lxml.etree
+import logging
+import platform
+import random
+import shutil
+import subprocess
+import json
+import time
+import sys
+import os
+
+# the generated databases spread their entries over this many feeds
+FEEDS = 100
+# bump when the generated data changes so that cached databases are rebuilt
+GENERATOR_VERSION = 1
+# all dates are relative to this so that the data does not depend on today
+BASE_TIME = 1300000000
+# differences below this many seconds are never reported as regressions
+NOISE = 0.001
+
+WORDS = """feed reader entry title content link date unread category update
+download parse store database index query cache page image icon archive
+python sqlite gtk webkit soup lxml atom rss channel item guid summary
+the of and to in is that for on with as by at from this it be are was""".split()
+
+
+def feed_url(n):
+    return "http://feed%d.example.org/rss.xml"%n
+
+def words(rng, n):
+    return " ".join(rng.choice(WORDS) for i in range(n))
+
+def synthetic_entry(rng, feed, n):
+    return "http://feed%d.example.org/entry/%d"%(feed, n), {
+        'title': words(rng, 6),
+        'content': "<p>%s</p>"%words(rng, 30),
+        'link': "http://feed%d.example.org/entry/%d"%(feed, n),
+        'date': BASE_TIME - n*3600 - rng.randint(0, 3599),
+        'unread': rng.random() < 0.05,
+        'categories': ""
+    }
+
+def generate_db(path, entries, seed):
+    """
+    create a database at path with entries entries spread evenly over FEEDS
+    feeds, about 5% of them unread
+    """
+    rng = random.Random(seed)
+    feeddb = sqlite_db.SQLStorage(path)
+    for feed in range(FEEDS):
+        feeddb.ingest_feed(feed_url(feed), {'title': "feed %d"%feed},
+            [synthetic_entry(rng, feed, n) for n in range(entries//FEEDS)])
+    feeddb.close()
+
+def cached_db(workdir, entries, seed):
+    """
+    returns the path of the generated database with entries entries,
+    which is only generated once per workdir
+    """
+    path = os.path.join(workdir, "bench-%d-%d-%d.sqlite"%(GENERATOR_VERSION, seed, entries))
+    if not os.path.exists(path):
+        start = time.time()
+        generate_db(path+".tmp", entries, seed)
+        os.rename(path+".tmp", path)
+        print >>sys.stderr, "generated %s in %.1f seconds"%(path, time.time()-start)
+    return path
+
+def generate_feed(kind, items, seed):
+    """
+    returns an rss 2.0 or atom document with items entries
+    """
+    rng = random.Random(seed)
+    entries = [synthetic_entry(rng, 0, n) for n in range(items)]
+    if kind == 'rss':
+        return """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel><title>synthetic</title><link>http://feed0.example.org/</link><ttl>60</ttl>
+%s
+</channel></rss>"""%"\n".join("""<item><title>%s</title><guid>%s</guid><link>%s</link><pubDate>%s</pubDate><description>%s</description></item>"""%(
+            e['title'], itemid, e['link'], time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(e['date'])),
+            e['content'].replace("<", "&lt;")) for itemid, e in entries)
+    return """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>synthetic</title><link href="http://feed0.example.org/"/>
+%s
+</feed>"""%"\n".join("""<entry><id>%s</id><title>%s</title><link href="%s"/><updated>%s</updated><content type="html">%s</content></entry>"""%(
+            itemid, e['title'], e['link'], time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(e['date'])),
+            e['content'].replace("<", "&lt;")) for itemid, e in entries)
+
+def measure(func, repeat, setup=None):
+    """
+    run func repeat times, each time after setup if given, and return the
+    fastest and the median time in seconds
+    """
+    timings = list()
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    timings.sort()
+    return {'min': timings[0], 'median': timings[len(timings)//2], 'runs': timings}
+
+def load_gui():
+    """
+    returns the pyferea module or None if Gtk or WebKit are not available
+    """
+    try:
+        import pyferea
+    except (ImportError, RuntimeError) as e:
+        print >>sys.stderr, "skipping the gui benchmarks: %s"%e
+        return None
+    return pyferea
+
+def synthetic_config():
+    return dict((feed_url(feed), {'category': "category %d"%(feed%10)}) for feed in range(FEEDS))
+
+def bench_storage(path, entries, repeat, results):
+    # a copy so that the cached database stays the same
+    shutil.copy(path, path+".run")
+    feeddb = sqlite_db.SQLStorage(path+".run")
+    # every tenth feed, the benchmarks report the time for all of them
+    sample = [feed_url(feed) for feed in range(0, FEEDS, 10)]
+    rng = random.Random(entries)
+    counter = [entries]
+
+    def get_entries_all():
+        for feedurl in sample:
+            feeddb.get_entries_all(feedurl)
+    def get_entries_page():
+        for feedurl in sample:
+            feeddb.count_entries(feedurl)
+            feeddb.get_entries_page(feedurl, 0, 100)
+    def mark_unread():
+        with feeddb.conn:
+            feeddb.conn.executemany("""UPDATE entries SET unread=1 WHERE feed=? AND rowid%10=0""", ((f,) for f in sample))
+    def mark_read_feed():
+        for feedurl in sample:
+            feeddb.mark_read_feed(feedurl)
+    def ingest_new():
+        # 20 new entries per feed, like a typical update
+        for feedurl in sample:
+            items = list()
+            for i in range(20):
+                counter[0] += 1
+                items.append(synthetic_entry(rng, FEEDS, counter[0]))
+            feeddb.ingest_feed(feedurl, {'title': "feed"}, items)
+    # the newest 50 entries of each feed, like a document that brings
+    # nothing new
+    known = dict((feedurl, [(row['entry'], dict(row, content="", link=None, categories=""))
+        for row in feeddb.get_entries_all(feedurl)[:50]]) for feedurl in sample)
+    def ingest_known():
+        for feedurl in sample:
+            feeddb.ingest_feed(feedurl, {'title': "feed"}, known[feedurl])
+    def search():
+        feeddb.search("sqlite lxml")
+    def open_db():
+        sqlite_db.SQLStorage(path+".run").close()
+
+    benchmarks = [
+        ('open', open_db, None),
+        ('get_entries_all', get_entries_all, None),
+        ('get_entries_page', get_entries_page, None),
+        ('get_unread_counts', feeddb.get_unread_counts, None),
+        ('mark_read_feed', mark_read_feed, mark_unread),
+        ('ingest_new', ingest_new, None),
+        ('ingest_known', ingest_known, None),
+    ]
+    if feeddb.fts:
+        benchmarks.append(('search', search, None))
+    for name, func, setup in benchmarks:
+        results["storage/%d/%s"%(entries, name)] = measure(func, repeat, setup)
+    feeddb.close()
+    os.remove(path+".run")
+
+def bench_gui(pyferea, path, entries, repeat, results):
+    feeddb = sqlite_db.SQLStorage(path)
+    config = synthetic_config()
+    def feedtree():
+        pyferea.FeedTree(config, feeddb, None, 8, 2).destroy()
+    entrytree = pyferea.EntryTree(feeddb)
+    entrytree.display(feed_url(0))
+    def entrytree_update():
+        entrytree.update(feed_url(0))
+        # the rows a window shows at once
+        model = entrytree.get_model()
+        it = model.get_iter_first()
+        for i in range(50):
+            if not it:
+                break
+            model.get_value(it, 1)
+            it = model.iter_next(it)
+    results["gui/%d/feedtree"%entries] = measure(feedtree, repeat)
+    results["gui/%d/entrytree_update"%entries] = measure(entrytree_update, repeat)
+    entrytree.destroy()
+    feeddb.close()
+
+def bench_startup(path, entries, repeat, results, gui):
+    """
+    time fresh processes that open the database and, with gui, build the
+    feed list and show the first feed like pyferea does when it starts
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--startup", path]
+    if gui:
+        command.append("--gui")
+    def startup():
+        subprocess.check_call(command)
+    results["startup/%d/%s"%(entries, "gui" if gui else "storage")] = measure(startup, repeat)
+
+def startup(path, gui):
+    feeddb = sqlite_db.SQLStorage(path)
+    if gui:
+        import pyferea
+        pyferea.FeedTree(synthetic_config(), feeddb, None, 8, 2)
+        pyferea.EntryTree(feeddb).display(feed_url(0))
+    else:
+        feeddb.get_unread_counts()
+        feeddb.get_entries_page(feed_url(0), 0, 100)
+    feeddb.close()
+
+def bench_parse(items, seed, repeat, results):
+    for kind in ['rss', 'atom']:
+        data = generate_feed(kind, items, seed)
+        for name, backend in feedworker.PARSERS:
+            results["parse/%s/%d/%s"%(kind, items, name)] = measure(lambda: backend(data, feed_url(0)), repeat)
+        # a refresh of a known feed that stops after 10 known entries
+        def stream():
+            parser = feedworker.StreamParser(feed_url(0), lambda itemid: True, 10)
+            for i in range(0, len(data), 8192):
+                if parser.feed(data[i:i+8192]):
+                    break
+            parser.close()
+        results["parse/%s/%d/stream_known"%(kind, items)] = measure(stream, repeat)
+
+def compare(old, new, threshold):
+    """
+    print the changes from the results old to new and return the number of
+    benchmarks that got more than threshold percent slower
+    """
+    for key in ['python', 'sqlite', 'machine']:
+        if old['meta'].get(key) != new['meta'].get(key):
+            print "warning: %s differs: %s, %s"%(key, old['meta'].get(key), new['meta'].get(key))
+    regressions = 0
+    print "%-40s %10s %10s %8s"%("benchmark", "old ms", "new ms", "change")
+    for name in sorted(set(old['results']) | set(new['results'])):
+        if name not in old['results'] or name not in new['results']:
+            print "%-40s only in the %s run"%(name, "old" if name in old['results'] else "new")
+            continue
+        # the fastest run is the least disturbed by the rest of the system
+        before = old['results'][name]['min']
+        after = new['results'][name]['min']
+        change = (after - before)/before*100 if before else 0
+        flag = ""
+        if change > threshold and after - before > NOISE:
+            flag = "REGRESSION"
+            regressions += 1
+        elif change < -threshold and before - after > NOISE:
+            flag = "faster"
+        print "%-40s %10.2f %10.2f %+7.1f%% %s"%(name, before*1000, after*1000, change, flag)
+    return regressions
+
+def main():
+    parser = OptionParser(usage="%prog [options]\n       %prog --compare OLD.json NEW.json",
+        description="benchmark pyferea on synthetic databases and feeds and write the timings as json")
+    parser.add_option("--sizes", default="10000,100000,1000000", metavar="N,...",
+        help="numbers of entries of the generated databases (default: 10000,100000,1000000)")
+    parser.add_option("--feed-sizes", default="10,100,1000", metavar="N,...",
+        help="numbers of entries of the generated feeds (default: 10,100,1000)")
+    parser.add_option("--repeat", type="int", default=5, metavar="N",
+        help="run each benchmark N times (default: 5)")
+    parser.add_option("--seed", type="int", default=1, metavar="N",
+        help="seed of the generated data (default: 1)")
+    parser.add_option("--workdir", default="bench", metavar="DIR",
+        help="where the generated databases are kept between runs (default: ./bench)")
+    parser.add_option("--output", metavar="FILE",
+        help="write the results to FILE instead of stdout")
+    parser.add_option("--no-gui", action="store_true", default=False,
+        help="skip the benchmarks that need Gtk")
+    parser.add_option("--compare", action="store_true", default=False,
+        help="compare the results in OLD.json with those in NEW.json and exit with 1 if there are regressions")
+    parser.add_option("--threshold", type="float", default=10, metavar="PERCENT",
+        help="slowdown from which --compare reports a regression (default: 10)")
+    parser.add_option("--startup", metavar="DB", help=SUPPRESS_HELP)
+    parser.add_option("--gui", action="store_true", default=False, help=SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if options.startup:
+        startup(options.startup, options.gui)
+        return 0
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two result files")
+        with open(args[0]) as f:
+            old = json.load(f)
+        with open(args[1]) as f:
+            new = json.load(f)
+        regressions = compare(old, new, options.threshold)
+        print "%d regressions"%regressions
+        return 1 if regressions else 0
+
+    if not os.path.isdir(options.workdir):
+        os.makedirs(options.workdir)
+    pyferea = None if options.no_gui else load_gui()
+
+    results = dict()
+    for items in [int(n) for n in options.feed_sizes.split(",")]:
+        bench_parse(items, options.seed, options.repeat, results)
+    for entries in [int(n) for n in options.sizes.split(",")]:
+        path = cached_db(options.workdir, entries, options.seed)
+        bench_storage(path, entries, options.repeat, results)
+        bench_startup(path, entries, options.repeat, results, False)
+        if pyferea:
+            bench_gui(pyferea, path, entries, options.repeat, results)
+            bench_startup(path, entries, options.repeat, results, True)
+
+    report = {
+        'meta': {
+            'created': int(time.time()),
+            'python': platform.python_version(),
+            'sqlite': sqlite_db.sqlite3.sqlite_version,
+            'lxml': lxml.etree.__version__,
+            'feedparser': feedparser.__version__,
+            'machine': platform.machine(),
+            'repeat': options.repeat,
+            'seed': options.seed
+        },
+        'results': results
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    else:
+        print json.dumps(report, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
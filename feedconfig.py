@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import yaml
+import sqlite_db
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+def open_feeddb():
+    """
+    open pyferea.sqlite from the first location it exists in or create a
+    new one in the current directory
+    """
+    # try the following paths for pyferea.sqlite in this order
+    xdg_data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    feeddb_paths = [
+        "./pyferea.sqlite",
+        os.path.join(xdg_data_home, "pyferea", "pyferea.sqlite"),
+    ]
+    for path in feeddb_paths:
+        if os.path.exists(path):
+            return sqlite_db.SQLStorage(path)
+    log.warning("cannot find pyferea.sqlite in any of the following locations:")
+    for path in feeddb_paths:
+        log.warning(path)
+    log.warning("creating new db at %s", feeddb_paths[0])
+    return sqlite_db.SQLStorage(feeddb_paths[0])
+
+def data_dir(name):
+    """
+    returns the directory name below $XDG_DATA_HOME/pyferea and creates it
+    if necessary
+    """
+    xdg_data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    path = os.path.join(xdg_data_home, "pyferea", name)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def cache_dir(name):
+    """
+    returns the directory name below $XDG_CACHE_HOME/pyferea and creates it
+    if necessary
+    """
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(xdg_cache_home, "pyferea", name)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def load_config():
+    """
+    load feeds.yaml from the first location it exists in and exit if there
+    is none
+    """
+    # try the following paths for feeds.yaml in this order
+    xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+    feeds_paths = [
+        "./feeds.yaml",
+        os.path.join(xdg_config_home, "pyferea", "feeds.yaml"),
+        "/usr/share/pyferea/feeds.yaml.example"
+    ]
+    config = None
+    for path in feeds_paths:
+        if os.path.exists(path):
+            with open(path) as f:
+                config = yaml.load(f)
+            break
+    if not config:
+        log.error("cannot find feeds.yaml in any of the following locations:")
+        for path in feeds_paths:
+            log.error(path)
+        exit(1)
+    # the reserved key categories holds settings shared by all feeds of a
+    # category, the feeds can override them
+    categories = config.pop('categories', None) or dict()
+    for feedurl, feedprops in config.items():
+        defaults = categories.get(feedprops.get('category'), dict())
+        for key, value in defaults.items():
+            feedprops.setdefault(key, value)
+    return config
+
+def retention_policies(config):
+    """
+    returns a dictionary mapping the feeds in config that limit how many
+    entries to keep to the (keep, keepdays) tuple SQLStorage.prune takes
+    """
+    policies = dict()
+    for feedurl, feedprops in config.items():
+        keep = feedprops.get('keep')
+        keepdays = feedprops.get('keepdays')
+        if keep is not None or keepdays is not None:
+            policies[feedurl] = (keep, keepdays)
+    return policies
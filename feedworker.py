@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from lxml import etree
+from urlparse import urljoin
+from cgi import escape
+import feedparser
+import multiprocessing
+import time
+import re
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+CONTENT = '{http://purl.org/rss/1.0/modules/content/}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+SY = '{http://purl.org/rss/1.0/modules/syndication/}'
+XHTML = '{http://www.w3.org/1999/xhtml}'
+
+
+def normalize_entry(item):
+    """
+    turn a feedparser entry into the dictionary stored by sqlite_db
+    """
+    new_item = {
+        'link': item.get('link'),
+        'title': item.get('title'),
+        'date': item.get('published_parsed'),
+        'content': item.get('content'),
+        'categories': ','.join([cat for _, cat in item.get('categories', [])]) or "",
+        'unread': True
+    }
+
+    if not new_item['date']:
+        new_item['date'] = item.get('updated_parsed')
+
+    if new_item['date']:
+        new_item['date'] = int(time.mktime(new_item['date']))
+    else:
+        new_item['date'] = int(time.time())
+
+    if new_item['content']:
+        new_item['content'] = new_item['content'][0]
+    else:
+        new_item['content'] = item.get('summary_detail')
+
+    if new_item['content']:
+        new_item['content'] = new_item['content']['value']
+    else:
+        new_item['content'] = ""
+
+    return new_item
+
+def get_skip_hours(data):
+    """
+    feedparser does not understand the rss skipHours element, so extract
+    the hours from the raw document
+    """
+    match = re.search(r'<skipHours>(.*?)</skipHours>', data, re.S|re.I)
+    if not match:
+        return []
+    return sorted(set(int(h) % 24 for h in re.findall(r'<hour>\s*(\d+)\s*</hour>', match.group(1), re.I)))
+
+def parse_feedparser(data, baseuri=None):
+    """
+    parse the raw feed document given by data with feedparser, which
+    understands every dialect but is slow
+    """
+    try:
+        feedparse = feedparser.parse(data)
+    except:
+        return None
+
+    if feedparse.bozo != 0:
+        return None
+
+    entries = list()
+    ids = list()
+    for item in feedparse.entries:
+        # use guid with fallback to link as identifier
+        itemid = item.get("id", item.get("link"))
+        if not itemid:
+            # TODO: display error "cannot identify feeditems"
+            ids = None
+            break
+        entries.append((itemid, normalize_entry(item)))
+        ids.append(itemid)
+
+    return {
+        'title': feedparse.feed.get('title'),
+        'link': feedparse.feed.get('link'),
+        'hints': {
+            'ttl': feedparse.feed.get('ttl'),
+            'updateperiod': feedparse.feed.get('sy_updateperiod'),
+            'updatefrequency': feedparse.feed.get('sy_updatefrequency'),
+            'skiphours': get_skip_hours(data)
+        },
+        'entries': entries,
+        'ids': ids
+    }
+
+def clean_html(html, baseuri):
+    """
+    make the urls in html absolute and remove everything that is unsafe the
+    same way feedparser does it
+    """
+    html = feedparser._resolveRelativeURIs(html, baseuri, 'utf-8', u'text/html')
+    return feedparser._sanitizeHTML(html, 'utf-8', u'text/html')
+
+def child_text(element, tag):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return None
+    return child.text.strip()
+
+class StreamParser():
+    """
+    parses rss 2.0 and atom feeds while they are downloaded
+    is_known(itemid) tells whether an entry is stored already. known
+    entries are skipped and once stop_after of them came in a row the rest
+    of the document is not needed anymore, because feeds list their
+    newest entries first
+    it only extracts the raw fields of the new entries, which
+    normalize_stream turns into what normalize_entry returns for the
+    entries of feedparser. all other kinds of documents need feedparser
+    """
+    def __init__(self, baseuri, is_known=None, stop_after=0):
+        self.baseuri = baseuri
+        self.is_known = is_known or (lambda itemid: False)
+        self.stop_after = stop_after
+        self.parser = etree.XMLPullParser(events=('start', 'end'), resolve_entities=False, no_network=True)
+        # 'rss' or 'atom' once the root element is known
+        self.format = None
+        self.title = None
+        self.link = None
+        self.hints = {'ttl': None, 'updateperiod': None, 'updatefrequency': None, 'skiphours': []}
+        self.entries = list()
+        # the ids of all entries, including the skipped known ones
+        self.ids = list()
+        self.known = 0
+        # set once the rest of the document is not needed
+        self.stopped = False
+        # set if the document cannot be parsed by this parser
+        self.failed = False
+
+    def feed(self, data):
+        """
+        parse the next chunk of the document, returns True once the rest
+        of the document is not needed or cannot be parsed by this parser
+        """
+        if self.stopped or self.failed:
+            return True
+        try:
+            self.parser.feed(data)
+            for event, element in self.parser.read_events():
+                self.handle(event, element)
+                if self.stopped or self.failed:
+                    break
+        except etree.XMLSyntaxError:
+            self.failed = True
+        return self.stopped or self.failed
+
+    def handle(self, event, element):
+        if event == 'start':
+            if self.format is None:
+                if element.tag == 'rss':
+                    self.format = 'rss'
+                elif element.tag == ATOM+'feed':
+                    self.format = 'atom'
+                else:
+                    self.failed = True
+            return
+        parent = element.getparent()
+        if parent is None:
+            return
+        if self.format == 'rss':
+            if element.tag == 'item':
+                self.add_entry(self.rss_entry(element))
+            elif parent.tag == 'channel' or element.tag == 'skipHours':
+                self.rss_channel(element)
+            else:
+                return
+        else:
+            if element.tag == ATOM+'entry':
+                self.add_entry(self.atom_entry(element))
+            elif parent.getparent() is None:
+                self.atom_feed(element)
+            else:
+                return
+        # everything up to here is handled, drop it to save memory
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
+
+    def rss_channel(self, element):
+        if element.tag == 'title':
+            self.title = (element.text or "").strip()
+        elif element.tag == 'link':
+            self.link = (element.text or "").strip()
+        elif element.tag == 'ttl':
+            self.hints['ttl'] = (element.text or "").strip()
+        elif element.tag == SY+'updatePeriod':
+            self.hints['updateperiod'] = (element.text or "").strip()
+        elif element.tag == SY+'updateFrequency':
+            self.hints['updatefrequency'] = (element.text or "").strip()
+        elif element.tag == 'skipHours':
+            self.hints['skiphours'] = sorted(set(int(hour.text) % 24 for hour in element.findall('hour')
+                if hour.text and hour.text.strip().isdigit()))
+
+    def atom_feed(self, element):
+        if element.tag == ATOM+'title':
+            self.title = (element.text or "").strip()
+        elif element.tag == ATOM+'link' and element.get('rel', 'alternate') == 'alternate':
+            self.link = urljoin(self.baseuri, element.get('href', ""))
+
+    def rss_entry(self, element):
+        guid = element.find('guid')
+        itemid = child_text(element, 'guid') or child_text(element, 'link')
+        link = child_text(element, 'link')
+        if not link and guid is not None and guid.get('isPermaLink') != 'false':
+            # the guid is the link unless it says otherwise
+            link = child_text(element, 'guid')
+        content = element.findtext(CONTENT+'encoded') or element.findtext('description')
+        return itemid, {
+            'link': urljoin(self.baseuri, link) if link else None,
+            'title': child_text(element, 'title'),
+            'date': child_text(element, 'pubDate') or child_text(element, DC+'date'),
+            'content': content
+        }
+
+    def atom_entry(self, element):
+        href = None
+        for candidate in element.findall(ATOM+'link'):
+            if candidate.get('rel', 'alternate') == 'alternate' and candidate.get('href'):
+                href = candidate.get('href')
+                break
+        content = element.find(ATOM+'content')
+        if content is None:
+            content = element.find(ATOM+'summary')
+        if content is None:
+            html = None
+        elif content.get('type') == 'xhtml':
+            # the markup is wrapped in a div that is not part of it. its
+            # text is unescaped by lxml, the children keep their tails
+            div = content.find(XHTML+'div')
+            if div is None:
+                div = content
+            html = escape(div.text or "") + "".join(etree.tostring(child, encoding=unicode) for child in div)
+        else:
+            # feedparser hands out html and plain text alike as they are
+            html = content.text
+        return child_text(element, ATOM+'id') or href, {
+            'link': urljoin(self.baseuri, href) if href else None,
+            'title': child_text(element, ATOM+'title'),
+            'date': child_text(element, ATOM+'published') or child_text(element, ATOM+'updated'),
+            'content': html
+        }
+
+    def add_entry(self, entry):
+        itemid, item = entry
+        if not itemid:
+            # like parse_feed, ignore everything after an entry without id
+            self.stopped = True
+            return
+        self.ids.append(itemid)
+        if self.is_known(itemid):
+            self.known += 1
+            if self.stop_after and self.known >= self.stop_after:
+                self.stopped = True
+            return
+        self.known = 0
+        self.entries.append((itemid, item))
+
+    def close(self):
+        """
+        returns the result of the document like parse_feed does or None if
+        it has to be parsed with parse_feed
+        if the document was not read to its end, the publisher's hints and
+        the list of all entry ids are None as they might come after the
+        entries
+        """
+        if self.failed or self.format is None:
+            return None
+        if not self.stopped:
+            try:
+                self.parser.close()
+            except etree.XMLSyntaxError:
+                return None
+        return {
+            'title': self.title,
+            'link': self.link,
+            'hints': None if self.stopped else self.hints,
+            'entries': self.entries,
+            'ids': None if self.stopped else self.ids
+        }
+
+def normalize_stream_entry(item, baseuri):
+    """
+    turn an entry collected by StreamParser into the dictionary stored by
+    sqlite_db like normalize_entry does
+    """
+    date = feedparser._parse_date(item['date']) if item['date'] else None
+    title = item['title']
+    if title and '<' in title:
+        title = clean_html(title, baseuri).decode('utf-8')
+    return {
+        'link': item['link'],
+        'title': title,
+        # the same local time interpretation of the utc date that
+        # normalize_entry applies
+        'date': int(time.mktime(date)) if date else int(time.time()),
+        'content': clean_html(item['content'], item['link'] or baseuri).decode('utf-8') if item['content'] else "",
+        # normalize_entry never finds any with feedparser 5
+        'categories': "",
+        'unread': True
+    }
+
+def normalize_stream(result, baseuri=None):
+    """
+    normalize the entries of a result of StreamParser.close, returns None
+    if that fails
+    parsing the dates and sanitizing the html is slow, so this runs inside
+    the worker processes, too
+    """
+    if not result:
+        return None
+    try:
+        result['entries'] = [(itemid, normalize_stream_entry(item, baseuri or ""))
+            for itemid, item in result['entries']]
+    except:
+        return None
+    return result
+
+def parse_lxml(data, baseuri=None):
+    """
+    parse the raw feed document given by data with StreamParser, which
+    only understands well-formed rss 2.0 and atom
+    """
+    try:
+        stream = StreamParser(baseuri or "")
+        stream.feed(data)
+        return normalize_stream(stream.close(), baseuri)
+    except:
+        return None
+
+# the parser backends in the order they are tried. each takes the raw
+# document and its url and returns the result described in parse_feed or
+# None if it cannot handle the document
+PARSERS = [
+    ('lxml', parse_lxml),
+    ('feedparser', parse_feedparser),
+]
+
+def parse_feed(data, baseuri=None, parser=None):
+    """
+    parse the raw feed document given by data with the first backend of
+    PARSERS that can handle it, starting with the one named parser
+    returns a dictionary with the feed title and homepage, the publisher's
+    hints about how often to poll the feed, a list of (itemid, entry)
+    tuples, the list of the ids of all entries in the document and the name
+    of the backend that parsed it or None if data was no valid feed
+    this runs inside the worker processes, so it must not raise and its
+    result must be picklable
+    """
+    names = [name for name, backend in PARSERS]
+    start = names.index(parser) if parser in names else 0
+    for name, backend in PARSERS[start:]:
+        result = backend(data, baseuri)
+        if result:
+            result['parser'] = name
+            return result
+    return None
+
+def timed(func, *args):
+    """
+    returns the result of func(*args) and the seconds it took
+    """
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+class ParsePool():
+    """
+    parses feeds in a pool of worker processes so that the main loop is not
+    blocked by feedparser. results are handed to the callback through
+    dispatch, which should be GLib.idle_add when running inside a main loop
+    """
+    def __init__(self, size, dispatch):
+        # size of None lets multiprocessing use one worker per cpu
+        self.pool = multiprocessing.Pool(size or None)
+        self.dispatch = dispatch
+
+    def parse(self, data, callback, *args, **kwargs):
+        """
+        parse data in a worker and call callback(result, elapsed, *args) with
+        the result of parse_feed and the seconds the worker spent on it
+        the optional keyword arguments baseuri and parser are passed on to
+        parse_feed
+        """
+        def _done(result):
+            # runs in the result handler thread of the pool
+            self.dispatch(callback, result[0], result[1], *args)
+        self.pool.apply_async(timed, (parse_feed, data, kwargs.get('baseuri'), kwargs.get('parser')), callback=_done)
+
+    def normalize(self, result, callback, *args, **kwargs):
+        """
+        normalize the entries of a result of StreamParser.close in a worker
+        and call callback(result, elapsed, *args) like parse does
+        the optional keyword argument baseuri is passed on to
+        normalize_stream
+        """
+        def _done(result):
+            self.dispatch(callback, result[0], result[1], *args)
+        self.pool.apply_async(timed, (normalize_stream, result, kwargs.get('baseuri')), callback=_done)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+def compare(fast, reference, baseuri):
+    """
+    returns the list of differences between the results of parse_lxml and
+    parse_feedparser for the document at baseuri
+    """
+    differences = list()
+    for key in ['title', 'link', 'hints', 'ids']:
+        if fast[key] != reference[key]:
+            differences.append("%s: %r != %r"%(key, fast[key], reference[key]))
+    if [e for e, v in fast['entries']] != [e for e, v in reference['entries']]:
+        differences.append("entry ids: %r != %r"%([e for e, v in fast['entries']], [e for e, v in reference['entries']]))
+    for (entry, fvalues), (rentry, rvalues) in zip(fast['entries'], reference['entries']):
+        # feedparser does not know the url of the document and leaves
+        # relative urls alone, parse_lxml makes them absolute
+        rcontent = rvalues['content']
+        if rcontent:
+            rcontent = clean_html(rcontent, rvalues['link'] or baseuri).decode('utf-8')
+        for key in sorted(rvalues):
+            rvalue = rcontent if key == 'content' else rvalues[key]
+            if fvalues[key] != rvalue:
+                differences.append("%s %s: %r != %r"%(entry, key, fvalues[key], rvalue))
+    return differences
+
+if __name__ == "__main__":
+    # compare the backends on the feed documents given as files or urls, so
+    # that changes to parse_lxml can be checked against a corpus of real
+    # feeds
+    import urllib2
+    import sys
+    if len(sys.argv) < 2:
+        print "usage: %s feed..."%sys.argv[0]
+        sys.exit(1)
+    mismatches = 0
+    for source in sys.argv[1:]:
+        if "://" in source:
+            data = urllib2.urlopen(source).read()
+        else:
+            with open(source) as f:
+                data = f.read()
+        results = dict()
+        timings = dict()
+        for name, backend in PARSERS:
+            start = time.time()
+            results[name] = backend(data, source)
+            timings[name] = time.time() - start
+        print "%s: %s"%(source, ", ".join("%s %.1f ms"%(name, timings[name]*1000) for name, backend in PARSERS))
+        fast, reference = results['lxml'], results['feedparser']
+        if not fast or not reference:
+            print "    lxml %s, feedparser %s"%("ok" if fast else "falls back", "ok" if reference else "fails")
+            continue
+        differences = compare(fast, reference, source)
+        for difference in differences:
+            print "    "+difference
+        if differences:
+            mismatches += 1
+    sys.exit(1 if mismatches else 0)
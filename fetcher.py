@@ -0,0 +1,642 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GObject, Gio, Soup
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlparse, urlunparse, urljoin
+from lxml import etree
+import feedworker
+import heapq
+import itertools
+import logging
+import re
+import time
+
+log = logging.getLogger(__name__)
+
+# priorities for FetchScheduler.queue_message, lower is earlier
+PRIORITY_HIGH = -1
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = 1
+
+# bounds in seconds for the polling interval of a feed
+MIN_INTERVAL = 15*60
+DEFAULT_INTERVAL = 60*60
+MAX_INTERVAL = 24*60*60
+# publishers may ask for longer intervals than we would choose ourselves
+MAX_PUBLISHER_INTERVAL = 7*24*60*60
+# check whether the icon of a site changed this often
+ICON_MAX_AGE = 7*24*60*60
+# feeds that lxml failed on go to feedparser right away for this long
+# before lxml gets another chance
+PARSER_RETRY = 24*60*60
+
+# the steps of opening a connection that FetchTimer records
+NETWORK_EVENTS = {
+    Gio.SocketClientEvent.RESOLVING: 'resolving',
+    Gio.SocketClientEvent.RESOLVED: 'resolved',
+    Gio.SocketClientEvent.CONNECTING: 'connecting',
+    Gio.SocketClientEvent.COMPLETE: 'connected'
+}
+
+SY_PERIODS = {
+    'hourly': 60*60,
+    'daily': 24*60*60,
+    'weekly': 7*24*60*60,
+    'monthly': 30*24*60*60,
+    'yearly': 365*24*60*60
+}
+
+
+class IconLinkFinder():
+    """
+    finds the first link tag in the head of a html document whose rel
+    attribute lists icon as one of its types. the document can be fed in
+    chunks as it arrives and feed tells once the head is over so that the
+    rest of the document does not have to be downloaded
+    """
+    # give up on documents with no end of their head in sight
+    max_size = 256*1024
+
+    def __init__(self):
+        self.href = None
+        self.done = False
+        self.size = 0
+        self.parser = etree.HTMLParser(target=self)
+
+    def feed(self, data):
+        """
+        parse the next chunk of the document, returns True once the rest of
+        the document is not needed anymore
+        """
+        if not self.done:
+            self.size += len(data)
+            self.parser.feed(data)
+            if self.size >= self.max_size:
+                self.done = True
+        return self.done
+
+    def start(self, tag, attrib):
+        if self.done:
+            return
+        if tag == 'body':
+            self.done = True
+        elif tag == 'link':
+            rel = attrib.get('rel')
+            if rel and 'icon' in rel.lower().split() and attrib.get('href'):
+                self.href = attrib['href']
+                self.done = True
+
+    def end(self, tag):
+        if tag == 'head':
+            self.done = True
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self.href
+
+def find_shortcut_icon_link_in_html(data):
+    """
+    data is a html document
+    returns the href attribute of the first link tag containing a rel attribute
+    that lists icon as one of its types
+    """
+    finder = IconLinkFinder()
+    finder.feed(data)
+    return finder.close()
+
+def http_max_age(cache_control, expires, now):
+    """
+    returns the number of seconds a response may be cached according to
+    its Cache-Control and Expires headers or 0 if they do not say
+    """
+    if cache_control:
+        match = re.search(r'max-age\s*=\s*"?(\d+)', cache_control)
+        if match:
+            return int(match.group(1))
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return 0
+    if expires:
+        expires = parsedate_tz(expires)
+        if expires:
+            return max(mktime_tz(expires) - int(now), 0)
+    return 0
+
+def publisher_interval(hints):
+    """
+    returns the minimum polling interval in seconds that the rss ttl and
+    sy:updatePeriod/sy:updateFrequency elements ask for or 0
+    """
+    interval = 0
+    try:
+        # ttl is given in minutes
+        interval = max(interval, int(hints.get('ttl') or 0)*60)
+    except ValueError:
+        pass
+    period = SY_PERIODS.get((hints.get('updateperiod') or '').strip().lower())
+    if period:
+        try:
+            frequency = max(int(hints.get('updatefrequency') or 1), 1)
+        except ValueError:
+            frequency = 1
+        interval = max(interval, period/frequency)
+    return min(interval, MAX_PUBLISHER_INTERVAL)
+
+def poll_interval(dates, mininterval, now):
+    """
+    derive the polling interval of a feed from the dates of its newest
+    entries (newest first), polling twice per typical gap between two
+    entries and slowing down for feeds that have been quiet for a while
+    mininterval is the lower bound requested by the publisher
+    """
+    if len(dates) >= 2:
+        gaps = sorted(a-b for a, b in zip(dates, dates[1:]))
+        interval = max(gaps[len(gaps)//2]/2, (now-dates[0])/4)
+        interval = min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+    else:
+        interval = DEFAULT_INTERVAL
+    return max(interval, mininterval)
+
+def next_due(now, interval, skiphours):
+    """
+    returns the time at which the feed should be polled next, moved past
+    the hours (in GMT) that the publisher asked us to skip
+    """
+    due = int(now + interval)
+    for _ in range(24):
+        if time.gmtime(due).tm_hour not in skiphours:
+            break
+        due = due - due%3600 + 3600
+    return due
+
+def reschedule(feeddb, feedurl, hints=None, maxage=0):
+    """
+    compute when feedurl is due next and store it in feeddb
+    hints are the polling hints of a freshly parsed feed document, without
+    them the hints of the last parsed document are used
+    maxage is the cache lifetime of the last response
+    """
+    schedule = feeddb.get_schedule(feedurl)
+    if hints is not None:
+        mininterval = publisher_interval(hints)
+        skiphours = ','.join(str(h) for h in hints['skiphours'])
+    else:
+        mininterval = schedule.get('mininterval') or 0
+        skiphours = schedule.get('skiphours') or ''
+    now = int(time.time())
+    interval = poll_interval(feeddb.get_entry_dates(feedurl), max(mininterval, maxage), now)
+    feeddb.set_schedule(feedurl, {
+        'interval': interval,
+        'nextdue': next_due(now, interval, [int(h) for h in skiphours.split(',') if h]),
+        'mininterval': mininterval,
+        'skiphours': skiphours
+    })
+
+
+class FetchScheduler(GObject.GObject):
+    """
+    sits between the feed reader and a Soup session and only hands a
+    limited number of messages to the session at a time, both in total and
+    per host, so that a full refresh does not open hundreds of sockets at
+    once and does not get rate limited by hosts serving many feeds
+    """
+
+    __gsignals__ = {
+        "progress": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (GObject.TYPE_INT, GObject.TYPE_INT))
+    }
+
+    def __init__(self, session, max_active=8, max_per_host=2):
+        GObject.GObject.__init__(self)
+        self.session = session
+        self.max_active = max_active
+        self.max_per_host = max_per_host
+        # the session must not limit us more than we limit ourselves
+        self.session.set_property("max-conns", max_active)
+        self.session.set_property("max-conns-per-host", max_per_host)
+        # host -> heap of (priority, sequence number, message, callback, args)
+        self.pending = dict()
+        # host -> number of messages currently handed to the session
+        self.active = dict()
+        self.sequence = itertools.count()
+        self.done = 0
+        self.total = 0
+        # start time of the current refresh run, which lasts until the
+        # queue is empty again
+        self.run = None
+
+    def queue_message(self, msg, callback, *args, **kwargs):
+        """
+        queue msg and call callback(session, msg, *args) once it finished,
+        like Soup.Session.queue_message does
+        the optional keyword argument priority orders the queue, messages of
+        the same priority are sent in the order they were queued
+        """
+        priority = kwargs.get('priority', PRIORITY_NORMAL)
+        host = msg.get_uri().host
+        if not self.total:
+            self.run = int(time.time())
+        heapq.heappush(self.pending.setdefault(host, list()),
+            (priority, next(self.sequence), msg, callback, args))
+        self.total += 1
+        self.emit("progress", self.done, self.total)
+        self.pump()
+
+    def cancel_message(self, msg):
+        """
+        cancel msg whether it is still queued or already sent
+        queued messages are dropped without calling their callback
+        """
+        for host, queue in self.pending.items():
+            for item in queue:
+                if item[2] == msg:
+                    queue.remove(item)
+                    heapq.heapify(queue)
+                    if not queue:
+                        del self.pending[host]
+                    self.finished()
+                    return
+        self.session.cancel_message(msg, 1) # SOUP_STATUS_CANCELLED
+
+    def in_flight(self):
+        """
+        returns the number of messages that are queued or sent
+        """
+        return self.total - self.done
+
+    def pump(self):
+        """
+        hand messages to the session until one of the limits is reached
+        """
+        while sum(self.active.values()) < self.max_active:
+            # pick the first message of all hosts that are below their limit
+            best = None
+            for host, queue in self.pending.iteritems():
+                if self.active.get(host, 0) >= self.max_per_host:
+                    continue
+                if best is None or queue[0] < self.pending[best][0]:
+                    best = host
+            if best is None:
+                return
+            _, _, msg, callback, args = heapq.heappop(self.pending[best])
+            if not self.pending[best]:
+                del self.pending[best]
+            self.active[best] = self.active.get(best, 0) + 1
+            self.session.queue_message(msg, self.complete_cb, (best, callback, args))
+
+    def complete_cb(self, session, msg, data):
+        host, callback, args = data
+        self.active[host] -= 1
+        if not self.active[host]:
+            del self.active[host]
+        try:
+            callback(session, msg, *args)
+        finally:
+            self.finished()
+            self.pump()
+
+    def finished(self):
+        self.done += 1
+        self.emit("progress", self.done, self.total)
+        if self.done == self.total:
+            # start counting from zero for the next refresh
+            self.done = self.total = 0
+
+
+class FetchTimer():
+    """
+    records where the time of a message went by listening to its signals
+    dns and connect are not recorded if the session reused a connection
+    """
+    def __init__(self, msg):
+        self.msg = msg
+        self.times = dict()
+        self.bytes = 0
+        msg.connect("network-event", self.network_event_cb)
+        msg.connect("wrote-headers", self.mark, 'sent')
+        msg.connect("got-headers", self.mark, 'headers')
+        msg.connect("got-chunk", self.got_chunk_cb)
+
+    def mark(self, msg, name):
+        # redirects send the message again, the last time counts
+        self.times[name] = time.time()
+
+    def network_event_cb(self, msg, event, connection):
+        if event in NETWORK_EVENTS:
+            self.mark(msg, NETWORK_EVENTS[event])
+
+    def got_chunk_cb(self, msg, chunk):
+        self.bytes += chunk.length
+
+    def span(self, start, end):
+        if start not in self.times or end not in self.times:
+            return None
+        return max(self.times[end] - self.times[start], 0)
+
+    def stats(self):
+        """
+        returns the http status, the size of the body and the seconds spent
+        resolving, connecting, waiting for and transferring the response as
+        stored by SQLStorage.add_fetch_stats
+        """
+        return {
+            'httpstatus': self.msg.status_code,
+            'bytes': self.bytes,
+            'dns': self.span('resolving', 'resolved'),
+            'connect': self.span('connecting', 'connected'),
+            'wait': self.span('sent', 'headers'),
+            'transfer': self.span('headers', 'finished')
+        }
+
+class FeedUpdater():
+    """
+    the conditional GET, parse and ingest pipeline for single feeds
+    it does not depend on Gtk so that the gui and the headless fetcher can
+    both use it
+    """
+    def __init__(self, feeddb, scheduler, parsepool, stop_after=10):
+        self.feeddb = feeddb
+        self.scheduler = scheduler
+        # host -> list of (feedurl, callback) waiting for its icon
+        self.icon_waiting = dict()
+        self.parsepool = parsepool
+        # number of known entries in a row after which the download of a
+        # feed is stopped, 0 always downloads and parses whole feeds
+        self.stop_after = stop_after
+
+    def update(self, feedurl, callback, priority=PRIORITY_NORMAL):
+        """
+        fetch, parse and store feedurl and call callback(feedurl, result)
+        once done. result is a dictionary with the following keys:
+        status: one of 'error', 'notmodified', 'invalid' and 'updated'
+        new: list of entries that were added
+        newfeed: True if the feed was not in the database before
+        stats: where the time went as stored in the fetch_stats table
+        """
+        msg = Soup.Message.new("GET", feedurl)
+        feed = self.feeddb.get_feed(feedurl)
+        if feed.get('etag'):
+            msg.request_headers.append('If-None-Match', feed['etag'])
+        if feed.get('lastmodified'):
+            msg.request_headers.append('If-Modified-Since', feed['lastmodified'])
+
+        timer = FetchTimer(msg)
+        stats = {'parse': None, 'store': None}
+
+        def done(status, new=[], newfeed=False):
+            stats.update(timer.stats())
+            stats.update({'status': status, 'new': len(new)})
+            self.feeddb.add_fetch_stats(feedurl, stats)
+            log.info("%s %s: %d bytes, %d new", status, feedurl, stats['bytes'], stats['new'])
+            callback(feedurl, {'status': status, 'new': new, 'newfeed': newfeed, 'stats': stats})
+
+        # feeds that are stored already are parsed while they come in, so
+        # that the download can stop once only known entries follow. feeds
+        # that needed feedparser recently go to the worker pool right away
+        fallback = (feed.get('parser') == 'feedparser'
+            and time.time() - (feed.get('fallback') or 0) < PARSER_RETRY)
+        stream = None
+        if feed and self.stop_after and not fallback:
+            stream = feedworker.StreamParser(feedurl,
+                lambda itemid: self.feeddb.has_entry(feedurl, itemid), self.stop_after)
+            def got_chunk_cb(msg, chunk):
+                # skip the bodies of redirects
+                if msg.status_code != 200:
+                    return
+                start = time.time()
+                stopped = stream.feed(chunk.get_data()) and stream.stopped
+                stats['parse'] = (stats['parse'] or 0) + time.time() - start
+                if stopped:
+                    self.scheduler.cancel_message(msg)
+            msg.connect("got-chunk", got_chunk_cb)
+
+        def complete_cb(session, msg):
+            timer.mark(msg, 'finished')
+            if stream and stream.stopped:
+                # cancelled by got_chunk_cb
+                body_done(msg, stream.close())
+                return
+            if msg.status_code not in [200, 304]:
+                reschedule(self.feeddb, feedurl)
+                done('error')
+                return
+
+            if msg.status_code == 304:
+                reschedule(self.feeddb, feedurl, maxage=http_max_age(msg.response_headers.get_one('Cache-Control'),
+                    msg.response_headers.get_one('Expires'), time.time()))
+                done('notmodified')
+                return
+
+            body_done(msg, stream.close() if stream else None)
+
+        def body_done(msg, feedparse):
+            """
+            the body of msg was read as far as needed, feedparse is the
+            result of the stream parser if it could handle the document
+            """
+            # the server might tell us how long the feed stays unchanged
+            maxage = http_max_age(msg.response_headers.get_one('Cache-Control'),
+                msg.response_headers.get_one('Expires'), time.time())
+            etag = msg.response_headers.get_one('ETag')
+            lastmodified = msg.response_headers.get_one('Last-Modified')
+            if feedparse:
+                # the stream parser is the lxml backend of parse_feed. it
+                # only sorted out the known entries, the new ones are
+                # normalized and sanitized in the worker pool so that the
+                # main loop is not blocked
+                feedparse['parser'] = 'lxml'
+                if feedparse['entries']:
+                    self.parsepool.normalize(feedparse, parse_done_cb, etag, lastmodified, maxage, baseuri=feedurl)
+                else:
+                    parse_done_cb(feedparse, 0, etag, lastmodified, maxage)
+                return
+            # everything else is parsed in the worker pool, starting with
+            # feedparser if the stream parser failed already or lxml failed
+            # on this feed recently. parse_done_cb is called from the main
+            # loop once it is done
+            data = msg.response_body.flatten().get_data()
+            self.parsepool.parse(data, parse_done_cb, etag, lastmodified, maxage,
+                baseuri=feedurl, parser='feedparser' if stream or fallback else None)
+
+        def parse_done_cb(feedparse, elapsed, etag, lastmodified, maxage):
+            stats['parse'] = (stats['parse'] or 0) + elapsed
+            if not feedparse:
+                # retrieved data was no valid feed
+                reschedule(self.feeddb, feedurl, maxage=maxage)
+                done('invalid')
+                return
+
+            # re-read the feed as it might have changed while parsing
+            feed = self.feeddb.get_feed(feedurl)
+
+            # store all new items and the updated feed in one transaction.
+            # the entries of a stream are only the new ones, the ids tell
+            # which entries the document still lists. a stream that
+            # stopped early has neither hints nor ids
+            start = time.time()
+            stats['parser'] = feedparse['parser']
+            new = self.feeddb.ingest_feed(feedurl, {
+                'title': feedparse['title'] or feed.get('title'),
+                'homepage': feedparse.get('link'),
+                'etag': etag or feed.get('etag'),
+                'lastmodified': lastmodified or feed.get('lastmodified'),
+                'parser': feedparse['parser'],
+                # lxml was tried and failed unless the feed went to
+                # feedparser right away
+                'fallback': int(time.time()) if feedparse['parser'] == 'feedparser' and not fallback else None
+            }, feedparse['entries'], listed=feedparse['ids'])
+            reschedule(self.feeddb, feedurl, feedparse['hints'], maxage)
+            stats['store'] = time.time() - start
+
+            done('updated', new, not feed)
+        self.scheduler.queue_message(msg, complete_cb, priority=priority)
+        stats['run'] = self.scheduler.run
+
+    def icon_site(self, feedurl):
+        """
+        returns the homepage of feedurl, which is where its icon is looked
+        for, and the host the icon is shared by
+        """
+        homepage = urljoin(feedurl, self.feeddb.get_feed(feedurl).get('homepage') or '/')
+        return homepage, urlparse(homepage).netloc
+
+    def icon_due(self, feedurl):
+        """
+        returns True if the icon of feedurl has to be looked up because the
+        feed has none of its site yet or the site was not checked recently
+        """
+        homepage, host = self.icon_site(feedurl)
+        hosticon = self.feeddb.get_host_icon(host)
+        if not hosticon or (hosticon['checked'] or 0) + ICON_MAX_AGE <= time.time():
+            return True
+        return self.feeddb.get_feed(feedurl).get('faviconhash') != hosticon['faviconhash']
+
+    def update_icon(self, feedurl, callback):
+        """
+        find the icon of the homepage of feedurl, store it and call
+        callback(feedurl, faviconhash) with the hash of the stored icon or
+        None if there is none
+        feeds of the same host share the icon and it is only checked for
+        changes every ICON_MAX_AGE seconds
+        """
+        homepage, host = self.icon_site(feedurl)
+        if host in self.icon_waiting:
+            # another feed of this host is already looking
+            self.icon_waiting[host].append((feedurl, callback))
+            return
+        hosticon = self.feeddb.get_host_icon(host)
+        if hosticon and (hosticon['checked'] or 0) + ICON_MAX_AGE > time.time():
+            self.feeddb.set_feed_favicon(feedurl, hosticon['faviconhash'])
+            callback(feedurl, hosticon['faviconhash'])
+            return
+        self.icon_waiting[host] = [(feedurl, callback)]
+        def done(faviconhash):
+            for feedurl, callback in self.icon_waiting.pop(host):
+                self.feeddb.set_feed_favicon(feedurl, faviconhash)
+                callback(feedurl, faviconhash)
+        if hosticon and hosticon['iconurl']:
+            self.revalidate_icon(host, homepage, hosticon, done)
+        else:
+            self.discover_icon(host, homepage, done)
+
+    def revalidate_icon(self, host, homepage, hosticon, done):
+        """
+        ask whether the known icon of host changed
+        """
+        msg = Soup.Message.new("GET", hosticon['iconurl'])
+        if hosticon.get('etag'):
+            msg.request_headers.append('If-None-Match', hosticon['etag'])
+        if hosticon.get('lastmodified'):
+            msg.request_headers.append('If-Modified-Since', hosticon['lastmodified'])
+        def complete_cb(session, msg):
+            if msg.status_code == 304:
+                self.feeddb.touch_host_icon(host)
+                done(hosticon['faviconhash'])
+            elif not self.store_icon(host, hosticon['iconurl'], msg, done):
+                # the icon is gone, maybe the site links another one now
+                self.discover_icon(host, homepage, done)
+        self.scheduler.queue_message(msg, complete_cb, priority=PRIORITY_LOW)
+
+    def discover_icon(self, host, homepage, done):
+        """
+        look for the icon link in the head of homepage and fall back to
+        /favicon.ico. only the head of the homepage is downloaded
+        """
+        msg = Soup.Message.new("GET", homepage)
+        if not msg:
+            done(None)
+            return
+        # the chunks are parsed as they arrive, there is no need to keep them
+        msg.response_body.set_accumulate(False)
+        finder = IconLinkFinder()
+        def got_chunk_cb(msg, chunk):
+            # skip the bodies of redirects
+            if msg.status_code != 200:
+                return
+            if finder.feed(chunk.get_data()):
+                self.scheduler.cancel_message(msg)
+        msg.connect("got-chunk", got_chunk_cb)
+        favicon = urlunparse(urlparse(homepage)[:2] + ('favicon.ico', '', '', ''))
+        def complete_cb(session, msg):
+            href = finder.close()
+            if href:
+                self.fetch_icon(host, urljoin(msg.get_uri().to_string(False), href), favicon, done)
+            else:
+                self.fetch_icon(host, favicon, None, done)
+        self.scheduler.queue_message(msg, complete_cb, priority=PRIORITY_LOW)
+
+    def fetch_icon(self, host, url, fallback, done):
+        """
+        download the icon at url and store it for host, try the url given by
+        fallback if that fails
+        """
+        msg = Soup.Message.new("GET", url)
+        if not msg:
+            done(None)
+            return
+        def complete_cb(session, msg):
+            if self.store_icon(host, url, msg, done):
+                return
+            if fallback and fallback != url:
+                self.fetch_icon(host, fallback, None, done)
+                return
+            # remember that there is no icon, so that we do not look again
+            # before ICON_MAX_AGE passed
+            done(self.feeddb.set_host_icon(host, dict()))
+        self.scheduler.queue_message(msg, complete_cb, priority=PRIORITY_LOW)
+
+    def store_icon(self, host, url, msg, done):
+        """
+        store the icon of host that msg downloaded from url and pass its hash
+        to done. returns False if msg did not get an icon
+        """
+        if msg.status_code != 200:
+            return False
+        # servers answering missing icons with an error page
+        if 'html' in (msg.response_headers.get_one('Content-Type') or ''):
+            return False
+        data = msg.response_body.flatten().get_data()
+        if not data:
+            return False
+        done(self.feeddb.set_host_icon(host, {
+            'iconurl': url,
+            'data': data,
+            'etag': msg.response_headers.get_one('ETag'),
+            'lastmodified': msg.response_headers.get_one('Last-Modified')
+        }))
+        return True
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# update pyferea.sqlite without a gui, for example from cron or a systemd
+# timer. this must not import Gtk or WebKit.
+
+from gi.repository import GLib, GObject, Soup
+from optparse import OptionParser
+import feedconfig
+import feedworker
+import fetcher
+import archiver
+import logging
+import time
+import sys
+
+
+def fetch(feeddb, feedurls, options, config):
+    """
+    update the feeds given by feedurls and return a dictionary mapping each
+    of them to the result of fetcher.FeedUpdater.update
+    """
+    results = dict()
+    if not feedurls:
+        return results
+
+    parsepool = feedworker.ParsePool(options.parse_workers, GLib.idle_add)
+    session = Soup.SessionAsync.new()
+    session.add_feature(Soup.ContentDecoder())
+    session.set_property("timeout", 60)
+    scheduler = fetcher.FetchScheduler(session, options.max_connections, options.max_per_host)
+    updater = fetcher.FeedUpdater(feeddb, scheduler, parsepool, options.stop_after)
+    archive_session = Soup.SessionAsync.new()
+    archive_session.add_feature(Soup.ContentDecoder())
+    archive_session.set_property("timeout", 60)
+    archive = archiver.Archiver(feeddb,
+        fetcher.FetchScheduler(archive_session, options.archive_connections, 1),
+        feedconfig.data_dir("archive"))
+    loop = GLib.MainLoop()
+
+    # like FeedTree.updating, the loop ends once this is empty
+    updating = set(feedurls)
+    def finished(key):
+        updating.remove(key)
+        if not updating:
+            loop.quit()
+    def icon_cb(feedurl, faviconhash):
+        finished(feedurl+"_icon")
+    def archive_cb(feedurl):
+        finished(feedurl+"_archive")
+    def done_cb(feedurl, result):
+        results[feedurl] = result
+        if result['status'] in ['updated', 'notmodified'] and (result['newfeed'] or updater.icon_due(feedurl)):
+            updating.add(feedurl+"_icon")
+            updater.update_icon(feedurl, icon_cb)
+        feedprops = config.get(feedurl, {})
+        if result['new'] and feedprops.get('loadlink') and feedprops.get('archive'):
+            updating.add(feedurl+"_archive")
+            archive.archive(feedurl, result['new'], archive_cb)
+        finished(feedurl)
+    for feedurl in feedurls:
+        updater.update(feedurl, done_cb)
+    loop.run()
+
+    parsepool.close()
+    return results
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+        description="update pyferea.sqlite with the feeds in feeds.yaml without starting the gui")
+    parser.add_option("--all", action="store_true", default=False,
+        help="update all feeds and not only those that are due")
+    parser.add_option("--parse-workers", type="int", default=0, metavar="N",
+        help="number of processes parsing feeds (default: number of cpus)")
+    parser.add_option("--max-connections", type="int", default=8, metavar="N",
+        help="maximum number of concurrent feed downloads (default: 8)")
+    parser.add_option("--max-per-host", type="int", default=2, metavar="N",
+        help="maximum number of concurrent downloads per host (default: 2)")
+    parser.add_option("--stop-after", type="int", default=10, metavar="N",
+        help="stop downloading a feed once N entries in a row are known already, 0 always downloads whole feeds (default: 10)")
+    parser.add_option("--archive-connections", type="int", default=4, metavar="N",
+        help="maximum number of concurrent downloads for the offline archive (default: 4)")
+    parser.add_option("--compress-content", action="store_true", default=False,
+        help="compress the content of all stored entries and of all future ones instead of updating")
+    parser.add_option("--vacuum", action="store_true", default=False,
+        help="rebuild the database so that pruning shrinks the file instead of updating")
+    parser.add_option("--stats", action="store_true", default=False,
+        help="print where the time of the last updates of each feed went instead of updating")
+    parser.add_option("--verbose", action="store_true", default=False,
+        help="log what is being updated and downloaded")
+    parser.add_option("--debug", action="store_true", default=False,
+        help="log every database access, implies --verbose")
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO if options.verbose else logging.WARNING,
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    # the parse workers deliver their results from a helper thread
+    GObject.threads_init()
+
+    feeddb = feedconfig.open_feeddb()
+
+    if options.compress_content:
+        before, after = feeddb.compress_entries()
+        print "entry content takes %.1f MiB instead of %.1f MiB, saved %.1f MiB"%(
+            after/1048576.0, before/1048576.0, (before-after)/1048576.0)
+        feeddb.close()
+        return 0
+
+    if options.vacuum:
+        start = time.time()
+        feeddb.vacuum()
+        print "vacuumed the database in %.1f seconds"%(time.time()-start)
+        feeddb.close()
+        return 0
+
+    if options.stats:
+        # averages over the runs kept in the fetch_stats table
+        print "%7s %5s %8s %8s %8s %8s  %s"%("updates", "304", "KiB", "net ms", "parse ms", "store ms", "feed")
+        for row in feeddb.get_feed_stats():
+            network = sum(row[key] or 0 for key in ['dns', 'connect', 'wait', 'transfer'])
+            print "%7d %4.0f%% %8.1f %8.0f %8.0f %8.0f  %s"%(row['fetches'], 100.0*row['notmodified']/row['fetches'],
+                (row['bytes'] or 0)/1024, network*1000, (row['parse'] or 0)*1000, (row['store'] or 0)*1000, row['feed'])
+        feeddb.close()
+        return 0
+
+    config = feedconfig.load_config()
+
+    stale = feeddb.check_unread()
+    if stale:
+        print "recounting the unread entries of %d feeds"%len(stale)
+        feeddb.recount_unread(stale)
+
+    if options.all:
+        feedurls = list(config)
+    else:
+        schedule = feeddb.get_schedule_all()
+        now = time.time()
+        feedurls = [feedurl for feedurl in config if schedule.get(feedurl, 0) <= now]
+
+    start = time.time()
+    results = fetch(feeddb, feedurls, options, config)
+
+    statuses = dict()
+    for feedurl, result in sorted(results.items()):
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        if result['status'] in ['error', 'invalid']:
+            print "%s: %s"%(result['status'], feedurl)
+        elif result['new']:
+            print "%d new: %s"%(len(result['new']), feedurl)
+    print "updated %d of %d feeds in %.1f seconds: %d new entries, %s"%(
+        len(results), len(config), time.time()-start,
+        sum(len(r['new']) for r in results.values()),
+        ", ".join("%d %s"%(n, s) for s, n in sorted(statuses.items())) or "nothing due")
+    if results:
+        totals = dict((key, sum(r['stats'][key] or 0 for r in results.values()))
+            for key in ['bytes', 'dns', 'connect', 'wait', 'transfer', 'parse', 'store'])
+        print "downloaded %.1f KiB, spent %.1f s resolving, %.1f s connecting, %.1f s waiting, %.1f s transferring, %.1f s parsing and %.1f s storing"%(
+            totals['bytes']/1024.0, totals['dns'], totals['connect'], totals['wait'], totals['transfer'], totals['parse'], totals['store'])
+    feeddb.trim_fetch_stats()
+
+    pruned = sum(deleted for feedurl, deleted in feeddb.prune(feedconfig.retention_policies(config)))
+    if pruned:
+        print "pruned %d old entries"%pruned
+        deleted, size = archiver.sweep(feeddb, feedconfig.data_dir("archive"))
+        if deleted:
+            print "deleted %d archived files of %.1f MiB"%(deleted, size/1048576.0)
+
+    feeddb.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# a persistent http cache for the web view, so that articles and the images
+# in feed content do not have to be downloaded again on every visit
+
+from gi.repository import Soup
+
+
+class HttpCache():
+    """
+    adds a Soup.Cache of at most max_size bytes in directory to session
+    and counts how many requests it could answer, so that its size can be
+    tuned. the cache drops the least recently and least often used
+    responses once it is full
+    """
+    def __init__(self, session, directory, max_size):
+        self.cache = Soup.Cache.new(directory, Soup.CacheType.SINGLE_USER)
+        self.cache.set_max_size(max_size)
+        # read the index of the last run
+        self.cache.load()
+        session.add_feature(self.cache)
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        # messages that went to the network -> their http status
+        self.sent = dict()
+        # Soup.Cache.has_response is not part of the public api, so tell
+        # the answers apart by whether a request was written at all
+        session.connect("request-queued", self.request_queued_cb)
+        session.connect("request-unqueued", self.request_unqueued_cb)
+
+    def request_queued_cb(self, session, msg):
+        if msg.method != "GET":
+            return
+        def wrote_headers_cb(msg):
+            self.sent[msg] = None
+        def got_headers_cb(msg):
+            self.sent[msg] = msg.status_code
+        msg.connect("wrote-headers", wrote_headers_cb)
+        msg.connect("got-headers", got_headers_cb)
+
+    def request_unqueued_cb(self, session, msg):
+        if msg.method != "GET":
+            return
+        if msg not in self.sent:
+            # answered from the cache without asking the server
+            if 200 <= msg.status_code < 300:
+                self.hits += 1
+            return
+        status = self.sent.pop(msg)
+        if status == 304:
+            self.revalidated += 1
+        else:
+            self.misses += 1
+
+    def stats(self):
+        """
+        returns a dictionary with the number of hits, revalidations and
+        misses so far and the hit rate
+        """
+        total = self.hits + self.revalidated + self.misses
+        return {
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'hitrate': float(self.hits)/total if total else 0.0
+        }
+
+    def close(self):
+        """
+        write the pending responses and the index to disk
+        """
+        self.cache.flush()
+        self.cache.dump()
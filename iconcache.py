@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GdkPixbuf
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+def pixbuf_new_from_file_in_memory(data, size=None):
+    """
+    return a pixbuf of imagedata given by data
+    optionally resize image to width/height tuple given by size
+    """
+    try:
+        loader = GdkPixbuf.PixbufLoader()
+        if size:
+            loader.set_size(*size)
+        loader.write(data)
+        loader.close()
+        return loader.get_pixbuf()
+    except:
+        log.warning("cannot load icon")
+        log.debug("%s", data.encode('base64_codec'))
+        return None
+
+class IconCache():
+    """
+    decodes and scales each favicon once. icons are keyed by the hash
+    SQLStorage stores them under, so feeds sharing an icon share the pixbuf.
+    if cachedir is given, the scaled icons are kept there as png files so
+    that the next start does not have to decode them again
+    """
+    def __init__(self, feeddb, cachedir=None, size=(16, 16)):
+        self.feeddb = feeddb
+        self.cachedir = cachedir
+        self.size = size
+        # hash -> pixbuf, None for icons that cannot be decoded
+        self.pixbufs = dict()
+
+    def get(self, faviconhash):
+        """
+        returns the pixbuf of the icon with hash faviconhash or None if it
+        cannot be decoded
+        """
+        if faviconhash in self.pixbufs:
+            return self.pixbufs[faviconhash]
+        pixbuf = self.load(faviconhash)
+        if pixbuf is None:
+            data = self.feeddb.get_favicon(faviconhash)
+            if data:
+                pixbuf = pixbuf_new_from_file_in_memory(data, self.size)
+            if pixbuf is not None:
+                self.save(faviconhash, pixbuf)
+        self.pixbufs[faviconhash] = pixbuf
+        return pixbuf
+
+    def path(self, faviconhash):
+        return os.path.join(self.cachedir, "%s-%dx%d.png"%(faviconhash, self.size[0], self.size[1]))
+
+    def load(self, faviconhash):
+        if not self.cachedir:
+            return None
+        try:
+            return GdkPixbuf.Pixbuf.new_from_file(self.path(faviconhash))
+        except:
+            return None
+
+    def save(self, faviconhash, pixbuf):
+        if not self.cachedir:
+            return
+        # write to a temporary file first so that there are no partial files
+        path = self.path(faviconhash)
+        try:
+            pixbuf.savev(path+".tmp", "png", [], [])
+            os.rename(path+".tmp", path)
+        except:
+            log.warning("cannot write %s", path)
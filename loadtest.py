@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# refresh load test against a farm of generated feeds served from this
+# machine. the farm runs in its own process and listens on 127.0.0.N, one
+# address per simulated host, so that the per host limits apply. the real
+# fetch, parse and ingest pipeline of headless.py updates all feeds for a
+# number of rounds, between which some of the feeds get new entries.
+
+from gi.repository import GLib, GObject, Soup
+from optparse import OptionParser
+from email.utils import formatdate
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from cStringIO import StringIO
+import multiprocessing
+import threading
+import feedworker
+import fetcher
+import sqlite_db
+import tempfile
+import logging
+import resource
+import urllib2
+import random
+import shutil
+import gzip
+import json
+import time
+import sys
+import os
+
+# all dates are relative to this so that the feeds do not depend on today
+BASE_TIME = 1300000000
+# how often the stall monitor expects to run, in seconds
+STALL_TICK = 0.01
+
+
+class FeedFarm():
+    """
+    the feed documents served in each round. feed m has its own number of
+    entries, which grows in each round with the probability given by change
+    the documents only depend on the options, so the server process and
+    the test agree on them without talking to each other
+    """
+    def __init__(self, options):
+        self.options = options
+        # the round the server is in, set by the test through /round/N
+        self.round = 0
+
+    def host(self, m):
+        return m % self.options.hosts
+
+    def url(self, m):
+        return "http://127.0.0.%d:%d/feed/%d"%(self.host(m)+1, self.options.port, m)
+
+    def total(self, m, rnd):
+        """
+        returns the number of entries feed m has in round rnd
+        """
+        total = self.options.items
+        for r in range(1, rnd+1):
+            if random.Random("%d-%d-%d"%(self.options.seed, m, r)).random() < self.options.change/100.0:
+                total += self.options.new
+        return total
+
+    def kind(self, m):
+        """
+        returns 'rdf', 'malformed', 'rss' or 'atom'
+        """
+        band = random.Random("%d-%d"%(self.options.seed, m)).random()*100
+        if band < self.options.rdf:
+            return 'rdf'
+        if band < self.options.rdf + self.options.malformed:
+            return 'malformed'
+        return 'rss' if m % 2 else 'atom'
+
+    def document(self, m, total):
+        """
+        returns the document of feed m with the newest of its total entries
+        """
+        base = self.url(m)
+        kind = self.kind(m)
+        entries = list()
+        for k in range(total-1, max(total-self.options.items, 0)-1, -1):
+            rng = random.Random("%d-%d-%d"%(self.options.seed, m, k))
+            entries.append(("%s/entry/%d"%(base, k), "entry %d of feed %d"%(k, m),
+                BASE_TIME + k*3600, "<p>%s</p>"%" ".join("word%d"%rng.randint(0, 999) for i in range(rng.randint(20, 200)))))
+        if kind == 'rdf':
+            return """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns="http://purl.org/rss/1.0/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<channel rdf:about="%s"><title>feed %d</title><link>%s</link></channel>
+%s
+</rdf:RDF>"""%(base, m, base, "\n".join("""<item rdf:about="%s"><title>%s</title><link>%s</link><dc:date>%s</dc:date><description>%s</description></item>"""%(
+                itemid, title, itemid, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(date)), content.replace("<", "&lt;"))
+                for itemid, title, date, content in entries))
+        if kind == 'atom':
+            return """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>feed %d</title><link href="%s"/>
+%s
+</feed>"""%(m, base, "\n".join("""<entry><id>%s</id><title>%s</title><link href="%s"/><updated>%s</updated><content type="html">%s</content></entry>"""%(
+                itemid, title, itemid, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(date)), content.replace("<", "&lt;"))
+                for itemid, title, date, content in entries))
+        document = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel><title>feed %d</title><link>%s</link>
+%s
+</channel></rss>"""%(m, base, "\n".join("""<item><title>%s</title><guid>%s</guid><pubDate>%s</pubDate><description>%s</description></item>"""%(
+            title, itemid, formatdate(date, usegmt=True), content.replace("<", "&lt;"))
+            for itemid, title, date, content in entries))
+        if kind == 'malformed':
+            # an undefined entity and a missing end tag
+            document = document.replace("<title>", "<title>&nbsp;", 1)[:-len("</rss>")]
+        return document
+
+class FarmHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body="", headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return body
+
+    def do_GET(self):
+        farm = self.server.farm
+        options = farm.options
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "round":
+            farm.round = int(parts[1])
+            self.wfile.write(self.reply(200))
+            return
+        if len(parts) != 2 or parts[0] != "feed":
+            self.wfile.write(self.reply(404))
+            return
+        m = int(parts[1])
+        host = self.server.host
+        slow = options.error_hosts <= host < options.error_hosts + options.slow_hosts
+        time.sleep((options.latency + (options.slow_latency if slow else 0))/1000.0)
+        if host < options.error_hosts:
+            if m % 3 == 0:
+                self.wfile.write(self.reply(500))
+            elif m % 3 == 1:
+                self.wfile.write(self.reply(503, headers={"Retry-After": "3600"}))
+            else:
+                # hang up without an answer
+                self.close_connection = 1
+            return
+
+        total = farm.total(m, farm.round)
+        etag = '"%d-%d"'%(m, total)
+        lastmodified = formatdate(BASE_TIME + total*60, usegmt=True)
+        if options.conditional and (self.headers.get("If-None-Match") == etag
+                or self.headers.get("If-Modified-Since") == lastmodified):
+            self.wfile.write(self.reply(304, headers={"ETag": etag, "Last-Modified": lastmodified}))
+            return
+        body = farm.document(m, total)
+        headers = {"Content-Type": "application/xml; charset=utf-8"}
+        if options.conditional:
+            headers.update({"ETag": etag, "Last-Modified": lastmodified})
+        if options.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressed = StringIO()
+            with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+                f.write(body)
+            body = compressed.getvalue()
+            headers["Content-Encoding"] = "gzip"
+        body = self.reply(200, body, headers)
+        if not slow:
+            self.wfile.write(body)
+            return
+        # slow hosts trickle their documents
+        for i in range(0, len(body), 1024):
+            self.wfile.write(body[i:i+1024])
+            self.wfile.flush()
+            time.sleep(options.slow_latency/10000.0)
+
+class FarmServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def serve(options, ready):
+    """
+    run the farm, one server per simulated host, until terminated
+    """
+    farm = FeedFarm(options)
+    servers = list()
+    for host in range(options.hosts):
+        server = FarmServer(("127.0.0.%d"%(host+1), options.port), FarmHandler)
+        server.farm = farm
+        server.host = host
+        servers.append(server)
+    for server in servers:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    ready.set()
+    while True:
+        time.sleep(3600)
+
+class StallMonitor():
+    """
+    measures how much later than expected a timer fires, which is how long
+    the main loop was blocked
+    """
+    def __init__(self):
+        self.last = time.time()
+        self.max = 0
+        self.total = 0
+        self.source = GLib.timeout_add(int(STALL_TICK*1000), self.tick)
+
+    def tick(self):
+        now = time.time()
+        stall = now - self.last - STALL_TICK
+        if stall > 0:
+            self.total += stall
+            self.max = max(self.max, stall)
+        self.last = now
+        return True
+
+    def stop(self):
+        GLib.source_remove(self.source)
+
+def peak_rss(processes):
+    """
+    returns the summed peak resident set sizes of processes in kilobytes as
+    /proc reports them, or None without /proc. getrusage cannot tell, as
+    RUSAGE_CHILDREN only covers children that were waited for
+    """
+    total = 0
+    for process in processes:
+        try:
+            with open("/proc/%d/status"%process.pid) as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except IOError:
+            return None
+    return total
+
+def refresh(feeddb, updater, feedurls):
+    """
+    update feedurls like headless.fetch does and return the results and
+    how the main loop fared
+    """
+    results = dict()
+    loop = GLib.MainLoop()
+    def done_cb(feedurl, result):
+        results[feedurl] = result
+        if len(results) == len(feedurls):
+            loop.quit()
+    monitor = StallMonitor()
+    start = time.time()
+    for feedurl in feedurls:
+        updater.update(feedurl, done_cb)
+    loop.run()
+    monitor.stop()
+    return results, time.time() - start, monitor
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+        description="update a farm of generated feeds served from this machine and report how long it took")
+    parser.add_option("--feeds", type="int", default=2000, metavar="N",
+        help="number of feeds (default: 2000)")
+    parser.add_option("--hosts", type="int", default=50, metavar="N",
+        help="number of hosts serving them, at most 254 (default: 50)")
+    parser.add_option("--items", type="int", default=30, metavar="N",
+        help="number of entries per feed document (default: 30)")
+    parser.add_option("--rounds", type="int", default=3, metavar="N",
+        help="number of refreshes, the first one sees all feeds for the first time (default: 3)")
+    parser.add_option("--change", type="float", default=20, metavar="PERCENT",
+        help="share of the feeds that get new entries before each further round (default: 20)")
+    parser.add_option("--new", type="int", default=3, metavar="N",
+        help="number of entries a changed feed gets (default: 3)")
+    parser.add_option("--latency", type="int", default=50, metavar="MS",
+        help="time every host takes to answer (default: 50)")
+    parser.add_option("--slow-hosts", type="int", default=2, metavar="N",
+        help="number of hosts that answer late and send their documents slowly (default: 2)")
+    parser.add_option("--slow-latency", type="int", default=2000, metavar="MS",
+        help="additional time the slow hosts take (default: 2000)")
+    parser.add_option("--error-hosts", type="int", default=2, metavar="N",
+        help="number of hosts that fail all requests (default: 2)")
+    parser.add_option("--malformed", type="float", default=2, metavar="PERCENT",
+        help="share of the feeds that are no well-formed xml (default: 2)")
+    parser.add_option("--rdf", type="float", default=5, metavar="PERCENT",
+        help="share of the feeds in rss 1.0, which only feedparser understands (default: 5)")
+    parser.add_option("--no-conditional", action="store_false", dest="conditional", default=True,
+        help="do not send ETag and Last-Modified, so that every round downloads everything")
+    parser.add_option("--no-gzip", action="store_false", dest="gzip", default=True,
+        help="do not compress the documents")
+    parser.add_option("--port", type="int", default=8765, metavar="PORT",
+        help="port the hosts listen on (default: 8765)")
+    parser.add_option("--seed", type="int", default=1, metavar="N",
+        help="seed of the generated feeds (default: 1)")
+    parser.add_option("--parse-workers", type="int", default=0, metavar="N",
+        help="number of processes parsing feeds (default: number of cpus)")
+    parser.add_option("--max-connections", type="int", default=8, metavar="N",
+        help="maximum number of concurrent feed downloads (default: 8)")
+    parser.add_option("--max-per-host", type="int", default=2, metavar="N",
+        help="maximum number of concurrent downloads per host (default: 2)")
+    parser.add_option("--stop-after", type="int", default=10, metavar="N",
+        help="stop downloading a feed once N entries in a row are known already (default: 10)")
+    parser.add_option("--output", metavar="FILE",
+        help="also write the results of all rounds to FILE as json")
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if not 0 < options.hosts < 255:
+        parser.error("--hosts must be between 1 and 254")
+    if options.feeds < 1:
+        parser.error("--feeds must be at least 1")
+
+    # start the farm and the parse workers before soup starts its threads
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(options, ready))
+    server.daemon = True
+    server.start()
+    if not ready.wait(10):
+        print "the feed farm did not start"
+        return 1
+    GObject.threads_init()
+    parsepool = feedworker.ParsePool(options.parse_workers, GLib.idle_add)
+    # everything but the farm is a parse worker
+    workers = [p for p in multiprocessing.active_children() if p is not server]
+
+    workdir = tempfile.mkdtemp(prefix="pyferea-loadtest-")
+    feeddb = sqlite_db.SQLStorage(os.path.join(workdir, "pyferea.sqlite"))
+    session = Soup.SessionAsync.new()
+    session.add_feature(Soup.ContentDecoder())
+    session.set_property("timeout", 60)
+    scheduler = fetcher.FetchScheduler(session, options.max_connections, options.max_per_host)
+    updater = fetcher.FeedUpdater(feeddb, scheduler, parsepool, options.stop_after)
+    farm = FeedFarm(options)
+    feedurls = [farm.url(m) for m in range(options.feeds)]
+
+    report = list()
+    try:
+        for rnd in range(options.rounds):
+            # tell the farm which documents to serve, bypassing any proxy
+            urllib2.build_opener(urllib2.ProxyHandler({})).open(
+                "http://127.0.0.1:%d/round/%d"%(options.port, rnd)).read()
+            results, wall, monitor = refresh(feeddb, updater, feedurls)
+            statuses = dict()
+            for result in results.values():
+                statuses[result['status']] = statuses.get(result['status'], 0) + 1
+            run = feeddb.get_run_stats(results.values()[0]['stats']['run'])
+            summary = {
+                'round': rnd,
+                'wall': wall,
+                'statuses': statuses,
+                'new': sum(len(r['new']) for r in results.values()),
+                'bytes': run['bytes'],
+                'network': run['dns'] + run['connect'] + run['wait'] + run['transfer'],
+                'parse': run['parse'],
+                'store': run['store'],
+                'stall_max': monitor.max,
+                'stall_total': monitor.total,
+                # kilobytes on linux
+                'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'workers_peak_rss': peak_rss(workers),
+            }
+            report.append(summary)
+            print "round %d: %d feeds in %.1f s, %s, %d new entries"%(rnd, len(results), wall,
+                ", ".join("%d %s"%(n, s) for s, n in sorted(statuses.items())), summary['new'])
+            print "    %.1f MiB, %.1f s network, %.1f s parsing, %.1f s storing (summed over all feeds)"%(
+                summary['bytes']/1048576.0, summary['network'], summary['parse'], summary['store'])
+            rss = "%.1f MiB"%(summary['peak_rss']/1024.0)
+            if summary['workers_peak_rss'] is not None:
+                rss += " + %.1f MiB in %d parse workers"%(summary['workers_peak_rss']/1024.0, len(workers))
+            print "    main loop stalled %.0f ms in total, %.0f ms at most, peak rss %s"%(
+                monitor.total*1000, monitor.max*1000, rss)
+    finally:
+        parsepool.close()
+        feeddb.close()
+        shutil.rmtree(workdir)
+        server.terminate()
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump({'options': vars(options), 'rounds': report}, f, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
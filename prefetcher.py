@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# warms up the entries following the selected one, so that walking down the
+# entry list does not wait for the database or the network
+
+from gi.repository import Gio, Soup
+from urlparse import urljoin
+import collections
+import re
+
+
+def image_urls(content, baseuri):
+    """
+    returns the absolute urls of the images in the html snippet content
+    """
+    urls = list()
+    for src in re.findall(r'<img\s[^>]*?src\s*=\s*["\']([^"\']+)["\']', content or "", re.I):
+        url = urljoin(baseuri or "", src.strip())
+        if url.startswith('http') and url not in urls:
+            urls.append(url)
+    return urls
+
+def network_metered():
+    """
+    returns True if the system says that traffic is expensive
+    """
+    try:
+        return Gio.NetworkMonitor.get_default().get_network_metered()
+    except AttributeError:
+        # needs glib 2.46
+        return False
+
+class Prefetcher():
+    """
+    reads the upcoming entries from the database and requests the pages of
+    loadlink feeds or the images in the content of the others through
+    session, whose http cache then has them once they are displayed
+    at most per_entry requests per upcoming entry are in flight, the ones
+    for entries that are not upcoming anymore are cancelled. nothing is
+    downloaded on metered connections
+    """
+    def __init__(self, feeddb, session, config, archive, per_entry=2):
+        self.feeddb = feeddb
+        self.session = session
+        self.config = config
+        self.archive = archive
+        self.per_entry = per_entry
+        # (feed, entry) -> row of get_entry
+        self.entries = collections.OrderedDict()
+        # messages that are still in flight
+        self.messages = list()
+
+    def get_entry(self, feed, entry):
+        """
+        like SQLStorage.get_entry but answered from the prefetched entries
+        if possible
+        """
+        item = self.entries.pop((feed, entry), None)
+        if item is None:
+            item = self.feeddb.get_entry(feed, entry)
+        return item
+
+    def cancel(self):
+        # cancelling may run complete_cb right away, which changes the list
+        for msg in list(self.messages):
+            self.session.cancel_message(msg, 1) # SOUP_STATUS_CANCELLED
+        self.messages = list()
+
+    def prefetch(self, upcoming):
+        """
+        warm up the (feed, entry) tuples in upcoming, the first ones first
+        """
+        self.cancel()
+        for key in self.entries.keys():
+            if key not in upcoming:
+                del self.entries[key]
+        urls = list()
+        for feed, entry in upcoming:
+            if (feed, entry) not in self.entries:
+                self.entries[(feed, entry)] = self.feeddb.get_entry(feed, entry)
+            item = self.entries[(feed, entry)]
+            if not item:
+                continue
+            if self.config.get(feed, {}).get('loadlink'):
+                if item.get('link') and not self.archive.path(feed, entry):
+                    urls.append(item['link'])
+            else:
+                # so that the images of one entry do not crowd out the
+                # entries after it
+                urls.extend(image_urls(item.get('content'), item.get('link'))[:self.per_entry])
+        if not self.per_entry or network_metered():
+            return
+        for url in urls:
+            msg = Soup.Message.new("GET", url)
+            if not msg:
+                continue
+            self.messages.append(msg)
+            self.session.queue_message(msg, self.complete_cb, None)
+
+    def complete_cb(self, session, msg, data):
+        if msg in self.messages:
+            self.messages.remove(msg)
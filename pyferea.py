@@ -24,15 +24,24 @@
 
 from gettext import gettext as _
 from gi.repository import Gtk, GLib, GObject, GdkPixbuf, Pango, WebKit, Soup
-import yaml
-from urlparse import urlparse, urlunparse, urljoin
-import feedparser
-from lxml import etree
-from cStringIO import StringIO
-import sqlite_db
+from pygtkcompat.generictreemodel import GenericTreeModel
+import feedworker
+import fetcher
+import feedconfig
+import iconcache
+import userscripts
+import archiver
+import httpcache
+import prefetcher
+import collections
+import logging
 import time
 import datetime
 import os, re
+import urllib
+
+# pyferea.py usually runs as __main__
+log = logging.getLogger("pyferea")
 
 def get_time_pretty(time):
     """
@@ -56,44 +65,6 @@ def get_time_pretty(time):
         return time.strftime("%b %d %Y")
 
 
-def pixbuf_new_from_file_in_memory(data, size=None):
-    """
-    return a pixbuf of imagedata given by data
-    optionally resize image to width/height tuple given by size
-    """
-    try:
-        loader = GdkPixbuf.PixbufLoader()
-        if size:
-            loader.set_size(*size)
-        loader.write(data)
-        loader.close()
-        return loader.get_pixbuf()
-    except:
-        print "cannot load icon"
-        print data.encode('base64_codec')
-        return None
-
-def find_shortcut_icon_link_in_html(data):
-    """
-    data is a html document that will be parsed by lxml.etree.HTMLParser()
-    returns the href attribute of the first link tag containing a rel attribute
-    that lists icon as one of its types
-    """
-    tree = etree.parse(StringIO(data), etree.HTMLParser())
-    #for link in tree.xpath("//link[@rel='icon' or @rel='shortcut icon']/@href"):
-    #    return link
-    links = tree.findall("//link")
-    for link in links:
-        rel = link.attrib.get('rel')
-        if not rel:
-            continue
-        if 'icon' not in rel.split():
-            continue
-        href = link.attrib.get('href')
-        if not href:
-            continue
-        return href
-
 def markup_escape_text(text):
     """
     use GLib.markup_escape_text to escape text for usage in pango markup
@@ -175,6 +146,14 @@ class ContentPane (Gtk.Notebook):
         self.show_all()
         self._hovered_uri = None
 
+        # the scripts are read once and reloaded when they change
+        xdg_data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+        self.userscripts = userscripts.ScriptRegistry([
+            ".",
+            os.path.join(xdg_data_home, "pyferea"),
+            "/usr/share/pyferea"
+        ])
+
     def load_uri (self, text):
         """load the given uri in the current web view"""
         #child = self.get_nth_page(self.get_current_page())
@@ -262,14 +241,8 @@ class ContentPane (Gtk.Notebook):
                 title = frame.get_uri()
             if title:
                 label.set_label(title)
-            #view.execute_script(open("youtube_html5_everywhere.user.js", "r").read())
-            for path in [".", "/usr/share/pyferea"]:
-                if not os.path.exists(path):
-                    continue
-                for f in [os.path.join(path, p) for p in os.listdir(path)]:
-                    if not f.endswith(".js"): continue
-                    if not os.path.isfile(f): continue
-                    view.execute_script(open(f, "r").read())
+            for source in self.userscripts.scripts_for(frame.get_uri()):
+                view.execute_script(source)
             """
             dom = view.get_dom_document()
             head = dom.get_head()
@@ -324,24 +297,24 @@ class ContentPane (Gtk.Notebook):
 
             def _status_changed_cb(download, status):
                 if download.get_status().value_name == 'WEBKIT_DOWNLOAD_STATUS_CANCELLED':
-                    print "download cancelled"
+                    log.info("download cancelled")
                 elif download.get_status().value_name == 'WEBKIT_DOWNLOAD_STATUS_CREATED':
-                    print "download created"
+                    log.info("download created")
                 elif download.get_status().value_name == 'WEBKIT_DOWNLOAD_STATUS_ERROR':
-                    print "download error"
+                    log.info("download error")
                 elif download.get_status().value_name == 'WEBKIT_DOWNLOAD_STATUS_FINISHED':
-                    print "download finished"
+                    log.info("download finished")
                 elif download.get_status().value_name == 'WEBKIT_DOWNLOAD_STATUS_STARTED':
-                    print "download started"
+                    log.info("download started")
             download.connect('notify::status', _status_changed_cb)
 
             def _progress_changed_cb(download, progress):
-                print "download", download.get_progress()*100, "%", download.get_current_size(), "bytes", download.get_elapsed_time(), "seconds"
+                log.debug("download %.0f%% %d bytes %.1f seconds", download.get_progress()*100, download.get_current_size(), download.get_elapsed_time())
             download.connect('notify::progress', _progress_changed_cb)
 
-            print "download total size:", download.get_total_size()
-            print "download uri:", download.get_uri()
-            print "download destination:", download_dir+"/"+download.get_suggested_filename()
+            log.info("download total size: %d", download.get_total_size())
+            log.info("download uri: %s", download.get_uri())
+            log.info("download destination: %s", download_dir+"/"+download.get_suggested_filename())
 
             return True
         web_view.connect("download-requested", _download_requested_cb)
@@ -481,12 +454,207 @@ class WebToolbar(Gtk.Toolbar):
             self._entry.set_text(self._entrytext)
 
 
+class EntryListModel(GenericTreeModel):
+    """
+    list model of the entries of a feed, newest first
+    rows are read from the database page by page when the view asks for
+    them and only the rows that are displayed get formatted
+    the number of rows is counted once, rows that disappear afterwards, for
+    example because another process pruned them, are empty until the model
+    catches up
+    columns: id, title markup, date markup
+    """
+
+    page_size = 100
+    # number of pages kept in memory
+    max_pages = 20
+
+    def __init__(self, feeddb, feedurl):
+        GenericTreeModel.__init__(self)
+        self.feeddb = feeddb
+        self.feedurl = feedurl
+        self.count = self.load_count()
+        self.pages = collections.OrderedDict()
+        # GenericTreeModel holds a reference to every rowref it hands out,
+        # so always hand out the same int object for the same row
+        self.rowrefs = dict()
+        # the idle source that recounts the rows once a page came up short
+        self.recounting = None
+
+    def rowref(self, n):
+        if n < 0 or n >= self.count:
+            return None
+        return self.rowrefs.setdefault(n, n)
+
+    def load_count(self):
+        return self.feeddb.count_entries(self.feedurl)
+
+    def load_page(self, offset, limit):
+        return self.feeddb.get_entries_page(self.feedurl, offset, limit)
+
+    def get_feed(self, it):
+        """
+        returns the feed of the row given by it
+        """
+        row = self.get_row(self.get_user_data(it))
+        return row.get('feed', self.feedurl) if row else self.feedurl
+
+    def get_row(self, n):
+        """
+        returns the database row at position n or None if it is gone
+        """
+        number = n // self.page_size
+        page = self.pages.pop(number, None)
+        if page is None:
+            page = self.load_page(number*self.page_size, self.page_size)
+            if len(self.pages) >= self.max_pages:
+                self.pages.popitem(last=False)
+        self.pages[number] = page
+        if n % self.page_size >= len(page):
+            # rows cannot be removed while the view reads them
+            if not self.recounting:
+                self.recounting = GLib.idle_add(self.recount)
+            return None
+        return page[n % self.page_size]
+
+    def recount(self):
+        """
+        drop the rows at the end that are not in the database anymore and
+        reload the others
+        """
+        self.recounting = None
+        count = self.load_count()
+        self.pages.clear()
+        while self.count > count:
+            self.count -= 1
+            self.row_deleted(Gtk.TreePath((self.count,)))
+        return False
+
+    def set_read(self, it):
+        """
+        show the row given by it as read
+        """
+        row = self.get_row(self.get_user_data(it))
+        if not row:
+            return
+        row['unread'] = 0
+        row.pop('markup', None)
+        self.row_changed(self.get_path(it), it)
+
+    def set_starred(self, it, starred):
+        """
+        show the row given by it as starred or not
+        """
+        row = self.get_row(self.get_user_data(it))
+        if not row:
+            return
+        row['starred'] = starred
+        row.pop('markup', None)
+        self.row_changed(self.get_path(it), it)
+
+    def insert_entries(self, entries):
+        """
+        insert rows for entries that were added to the database
+        """
+        positions = self.feeddb.get_entry_positions(self.feedurl, entries)
+        if not positions:
+            return
+        # the cached pages are shifted now, drop them
+        self.pages.clear()
+        # the positions are final ones, inserting them in ascending order
+        # keeps the rows before each insertion in place
+        for position, entry in positions:
+            self.count += 1
+            path = Gtk.TreePath((position,))
+            self.row_inserted(path, self.get_iter(path))
+
+    def set_read_all(self):
+        """
+        show all rows as read
+        """
+        for page in self.pages.values():
+            for row in page:
+                row['unread'] = 0
+                row.pop('markup', None)
+
+    def on_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def on_get_n_columns(self):
+        return 3
+
+    def on_get_column_type(self, n):
+        return GObject.TYPE_STRING
+
+    def on_get_iter(self, path):
+        return self.rowref(path[0])
+
+    def on_get_path(self, rowref):
+        return (rowref,)
+
+    def on_get_value(self, rowref, column):
+        row = self.get_row(rowref)
+        if not row:
+            return None if column == 0 else ""
+        if column == 0:
+            return row['entry']
+        if 'markup' not in row:
+            title = markup_escape_text(row.get('title', ""))
+            date = get_time_pretty(row['date'])
+            if row['unread']:
+                title = "<b>"+title+"</b>"
+                date = "<b>"+date+"</b>"
+            if row.get('starred'):
+                title = "\xe2\x98\x85 "+title
+            row['markup'] = (title, date)
+        return row['markup'][column-1]
+
+    def on_iter_next(self, rowref):
+        return self.rowref(rowref+1)
+
+    def on_iter_children(self, parent):
+        if parent is None:
+            return self.rowref(0)
+        return None
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return self.count
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None:
+            return self.rowref(n)
+        return None
+
+    def on_iter_parent(self, child):
+        return None
+
+class SearchResultModel(EntryListModel):
+    """
+    list model of the entries of all feeds matching a full text search,
+    best matches first
+    """
+
+    def __init__(self, feeddb, query):
+        self.query = query
+        EntryListModel.__init__(self, feeddb, None)
+
+    def load_count(self):
+        return self.feeddb.count_search(self.query)
+
+    def load_page(self, offset, limit):
+        return self.feeddb.search(self.query, offset, limit)
+
 class EntryTree(Gtk.TreeView):
     __gsignals__ = {
         "item-selected": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (GObject.TYPE_STRING, GObject.TYPE_STRING))
     }
 
-    def __init__(self, config, feeddb):
+    def __init__(self, feeddb):
         Gtk.TreeView.__init__(self)
 
         self.feeddb = feeddb
@@ -494,87 +662,121 @@ class EntryTree(Gtk.TreeView):
         def on_cursor_changed_cb(treeview):
             selection = self.get_selection()
             if not selection: return
-            _, it = selection.get_selected()
+            model, it = selection.get_selected()
             if not it: return
-            item = self.get_model().get_value(it, 0)
-            entry = self.feeddb.get_entry(self.feedurl, item)
-            if entry['unread']:
-                title = markup_escape_text(entry['title'])
-                date = get_time_pretty(entry['date'])
-                self.get_model().set_value(it, 1, title)
-                self.get_model().set_value(it, 2, date)
-                self.feeddb.mark_read(self.feedurl, item)
-            self.emit("item-selected", self.feedurl, item)
+            row = model.get_row(model.get_user_data(it))
+            if not row: return
+            item = row['entry']
+            # search results come from all feeds
+            feedurl = model.get_feed(it)
+            if row['unread']:
+                self.feeddb.mark_read(feedurl, item)
+                model.set_read(it)
+            self.emit("item-selected", feedurl, item)
         self.connect("cursor-changed", on_cursor_changed_cb)
 
-        self.models = dict()
-        # id, date, label
-        self.empty_model = Gtk.ListStore(GObject.TYPE_STRING, GObject.TYPE_INT, GObject.TYPE_STRING)
+        def on_key_press_event_cb(treeview, event):
+            if event.keyval != 115: # s
+                return False
+            model, it = self.get_selection().get_selected()
+            if not it or model is self.empty_model:
+                return False
+            row = model.get_row(model.get_user_data(it))
+            if not row:
+                return False
+            # starred entries are never pruned
+            feedurl = model.get_feed(it)
+            starred = not row.get('starred')
+            self.feeddb.set_starred(feedurl, row['entry'], starred)
+            model.set_starred(it, starred)
+            return True
+        self.connect("key-press-event", on_key_press_event_cb)
+
+        # id, title, date
+        self.empty_model = Gtk.ListStore(GObject.TYPE_STRING, GObject.TYPE_STRING, GObject.TYPE_STRING)
 
         cell = Gtk.CellRendererText()
         column1 = Gtk.TreeViewColumn("Date", cell, markup=2)
-        #column1.set_sort_column_id(0)
         column2 = Gtk.TreeViewColumn("Headline", cell, markup=1)
-        #column2.set_sort_column_id(1)
         self.append_column(column1)
         self.append_column(column2)
+        # all rows have the same height, so the view does not need to
+        # measure (and thereby load) every row of the model
+        self.set_fixed_height_mode(True)
+        column1.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column1.set_fixed_width(130)
+        column2.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column2.set_expand(True)
         self.set_model(self.empty_model)
         self.feedurl = None
 
-        for feedurl in config:
-            if self.feeddb.get_feed(feedurl):
-                self.update(feedurl)
+    def upcoming(self, n):
+        """
+        returns (feedurl, entry) tuples of the n entries after the cursor
+        """
+        model, it = self.get_selection().get_selected()
+        if not it or model is self.empty_model:
+            return list()
+        position = model.get_user_data(it)
+        rows = [model.get_row(i) for i in range(position+1, min(position+1+n, model.count))]
+        return [(row.get('feed', model.feedurl), row['entry']) for row in rows if row]
 
     def display(self, feedurl):
         if not feedurl or not self.feeddb.get_feed(feedurl):
             self.set_model(self.empty_model)
             self.feedurl = None
         else:
-            self.set_model(self.models[feedurl])
+            # the model only loads the rows that are displayed, so creating
+            # it is cheap and there is no need to keep models of other feeds
+            self.set_model(EntryListModel(self.feeddb, feedurl))
             self.feedurl = feedurl
 
+    def display_search(self, query):
+        """
+        display the entries of all feeds matching query
+        """
+        self.set_model(SearchResultModel(self.feeddb, query))
+        self.feedurl = None
+
     def update(self, feedurl):
-        model = Gtk.ListStore(GObject.TYPE_STRING, GObject.TYPE_STRING, GObject.TYPE_STRING)
-        # using model.set_sort_column_id is horribly slow, so append them
-        # sorted instead
-        for value in self.feeddb.get_entries_all(feedurl):
-            title = markup_escape_text(value.get('title', ""))
-            date = get_time_pretty(value['date'])
-            if value['unread']:
-                title = "<b>"+title+"</b>"
-                date = "<b>"+date+"</b>"
-            model.append([value['entry'], title, date])
-        def compare_date(model, a, b, data):
-            item1 = model.get_value(a, 0)
-            item2 = model.get_value(b, 0)
-            items = self.feeddb[feedurl]['items']
-            return -1 if items[item1]['date'] < items[item2]['date'] else 1
-        #model.set_sort_func(0, compare_date)
-        def compare_title(model, a, b, data):
-            item1 = model.get_value(a, 0)
-            item2 = model.get_value(b, 0)
-            items = self.feeddb[feedurl]['items']
-            return -1 if items[item1]['title'] < items[item2]['title'] else 1
-        #model.set_sort_func(1, compare_title) # deactivate both sortings as it takes too long if accidentally clicked
-        # this takes loooooong
-        #model.set_sort_column_id(0, Gtk.SortType.DESCENDING)
-        self.models[feedurl] = model
+        """
+        reload the entries of feedurl if it is displayed
+        """
         if self.feedurl == feedurl:
-            self.set_model(model)
+            self.set_model(EntryListModel(self.feeddb, feedurl))
+
+    def entries_added(self, feedurl, entries):
+        """
+        show the new entries of feedurl at their position
+        """
+        if self.feedurl == feedurl:
+            self.get_model().insert_entries(entries)
+
+    def feed_marked_read(self, feedurl):
+        if self.feedurl == feedurl:
+            self.get_model().set_read_all()
+            # only the displayed rows have to be redrawn
+            self.queue_draw()
 
 class FeedTree(Gtk.TreeView):
     __gsignals__ = {
         "refresh-begin": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, ()),
         "refresh-complete": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, ()),
+        "refresh-progress": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (GObject.TYPE_INT, GObject.TYPE_INT)),
         "feed-selected": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (GObject.TYPE_STRING,)),
-        "update-feed": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (GObject.TYPE_STRING,))
+        "entries-added": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (GObject.TYPE_STRING, GObject.TYPE_PYOBJECT)),
+        "feed-marked-read": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (GObject.TYPE_STRING,)),
+        "unread-changed": (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (GObject.TYPE_INT,))
     }
 
-    def __init__(self, config, feeddb):
+    def __init__(self, config, feeddb, parsepool, max_active, max_per_host, icon_cache_dir=None, stop_after=10):
         Gtk.TreeView.__init__(self)
 
         self.updating = set()
+        self.due_source = None
         self.feeddb = feeddb
+        self.parsepool = parsepool
+        self.icons = iconcache.IconCache(feeddb, icon_cache_dir)
 
         def on_button_press_event(treeview, event):
             if event.button != 3: return False
@@ -602,29 +804,34 @@ class FeedTree(Gtk.TreeView):
 
         # url, label, icon, popup
         self.model = Gtk.TreeStore(GObject.TYPE_STRING, GObject.TYPE_STRING, GdkPixbuf.Pixbuf, Gtk.Menu)
+        # feedurl -> row and category -> row so that rows can be found
+        # without walking the tree
+        self.rows = collections.OrderedDict()
+        self.category_rows = dict()
+
+        # the unread counters are kept by triggers, make sure that nothing
+        # changed them behind their back
+        stale = self.feeddb.check_unread()
+        if stale:
+            self.feeddb.recount_unread(stale)
 
         # reorganize configuration data into categories
-        categories = dict()
+        self.categories = dict()
+        self.feed_categories = dict()
         for feedurl, feedprops in config.items():
-            if feedprops['category'] not in categories:
-                categories[feedprops['category']] = list()
-            categories[feedprops['category']].append(feedurl)
+            if feedprops['category'] not in self.categories:
+                self.categories[feedprops['category']] = list()
+            self.categories[feedprops['category']].append(feedurl)
+            self.feed_categories[feedurl] = feedprops['category']
 
-        for category, feeds in categories.items():
+        for category, feeds in self.categories.items():
             it = self.model.append(None, [None, category, folder_icon, None])
+            self.category_rows[category] = Gtk.TreeRowReference.new(self.model, self.model.get_path(it))
             for feedurl in feeds:
                 feed = self.feeddb.get_feed(feedurl)
                 if feed:
-                    feed_icon = feed.get('favicon')
-                    if feed_icon:
-                        feed_icon = pixbuf_new_from_file_in_memory(feed_icon, (16, 16)) or error_icon
-                    else:
-                        feed_icon = self.render_icon(Gtk.STOCK_FILE, Gtk.IconSize.MENU, None)
-
-                    label = markup_escape_text(feed.get('title', feedurl))
-                    unread = feed.get('unread')
-                    if unread > 0:
-                        label = "<b>"+label+" (%d)"%unread+"</b>"
+                    feed_icon = self.feed_icon(feed)
+                    label = self.feed_label(feed)
                 else:
                     feed_icon = error_icon
                     label = feedurl
@@ -632,6 +839,8 @@ class FeedTree(Gtk.TreeView):
                 # use resulting iter to update popup menu entry
                 itc = self.model.append(it, [feedurl, label, feed_icon, None])
                 self.model.set_value(itc, 3, self.get_popup_menu(itc))
+                self.rows[feedurl] = Gtk.TreeRowReference.new(self.model, self.model.get_path(itc))
+        self.update_counts()
 
         column = Gtk.TreeViewColumn("Feeds")
         col_cell_img = Gtk.CellRendererPixbuf()
@@ -647,33 +856,94 @@ class FeedTree(Gtk.TreeView):
         self.expand_all()
         self.show()
 
-        self.session = Soup.SessionAsync.new()
-        self.session.add_feature(Soup.ContentDecoder())
+        session = Soup.SessionAsync.new()
+        session.add_feature(Soup.ContentDecoder())
+        # all requests go through the scheduler which limits the number of
+        # concurrent connections in total and per host
+        self.fetcher = fetcher.FetchScheduler(session, max_active, max_per_host)
+        def progress_cb(scheduler, done, total):
+            if total:
+                self.emit("refresh-progress", done, total)
+        self.fetcher.connect("progress", progress_cb)
+        self.updater = fetcher.FeedUpdater(self.feeddb, self.fetcher, self.parsepool, stop_after)
+
+    def feed_iter(self, feedurl):
+        """
+        returns the iter of the row of feedurl or None
+        """
+        row = self.rows.get(feedurl)
+        if not row or not row.valid():
+            return None
+        return self.model.get_iter(row.get_path())
+
+    def category_iter(self, category):
+        """
+        returns the iter of the row of category or None
+        """
+        row = self.category_rows.get(category)
+        if not row or not row.valid():
+            return None
+        return self.model.get_iter(row.get_path())
+
+    def iter_feeds(self):
+        """
+        yields the iters of all feeds in the tree
+        """
+        for feedurl in self.rows:
+            yield self.feed_iter(feedurl)
+
+    @staticmethod
+    def feed_label(feed):
+        label = markup_escape_text(feed['title'])
+        if feed['unread'] > 0:
+            label = "<b>"+label+" (%d)"%feed['unread']+"</b>"
+        return label
+
+    def feed_icon(self, feed):
+        """
+        returns the pixbuf to show next to feed
+        """
+        if not feed.get('faviconhash'):
+            return self.render_icon(Gtk.STOCK_FILE, Gtk.IconSize.MENU, None)
+        return (self.icons.get(feed['faviconhash'])
+            or self.render_icon(Gtk.STOCK_DIALOG_ERROR, Gtk.IconSize.MENU, None))
+
+    def update_counts(self, feedurl=None):
+        """
+        show the number of unread entries of the category of feedurl, or of
+        each category without feedurl, and tell the total to whoever listens
+        to unread-changed
+        """
+        if feedurl:
+            categories = [self.feed_categories[feedurl]]
+        else:
+            categories = self.categories.keys()
+        for category in categories:
+            it = self.category_iter(category)
+            if not it:
+                continue
+            self.model.set_value(it, 1, self.feed_label({'title': category,
+                'unread': self.feeddb.get_unread_sum(self.categories[category])}))
+        self.emit("unread-changed", self.feeddb.get_unread_total())
 
     def mark_read_all(self):
-        it = self.model.get_iter_first()
-        while (it):
-            itc = self.model.iter_children(it)
-            while (itc):
-                self.mark_read(itc)
-                itc = self.model.iter_next(itc)
-            it = self.model.iter_next(it)
+        for it in self.iter_feeds():
+            self.mark_read(it)
 
     def mark_read(self, it):
         feedurl = self.model.get_value(it, 0)
         feed = self.feeddb.get_feed(feedurl)
         self.feeddb.mark_read_feed(feedurl)
         self.model.set_value(it, 1, markup_escape_text(feed['title']))
-        self.emit("update-feed", feedurl)
+        self.update_counts(feedurl)
+        self.emit("feed-marked-read", feedurl)
 
-    def disable_context_update(self):
-        it = self.model.get_iter_first()
-        while (it):
-            itc = self.model.iter_children(it)
-            while (itc):
-                self.model.get_value(itc, 3).deactivate_update()
-                itc = self.model.iter_next(itc)
-            it = self.model.iter_next(it)
+    def set_update_sensitive(self, sensitive):
+        """
+        enable or disable updating via the context menu of all feeds
+        """
+        for it in self.iter_feeds():
+            self.model.get_value(it, 3).set_update_sensitive(sensitive)
 
     def get_popup_menu(self, it):
         popup = Gtk.Menu()
@@ -683,304 +953,202 @@ class FeedTree(Gtk.TreeView):
         update_item.set_label(_("Update"))
         def on_update_item_activate_cb(menuitem):
             self.emit("refresh-begin")
-            self.disable_context_update()
+            self.set_update_sensitive(False)
             self.updating.add(feedurl)
-            self.update_feed(it)
+            self.update_feed(it, fetcher.PRIORITY_HIGH)
         update_item.connect("activate", on_update_item_activate_cb)
 
         mark_item = Gtk.ImageMenuItem.new_from_stock(Gtk.STOCK_APPLY, None)
         mark_item.set_label(_("Mark As Read"))
         def on_mark_item_activate_cb(menuitem):
             self.mark_read(it)
-            self.emit("update-feed", feedurl)
         mark_item.connect("activate", on_mark_item_activate_cb)
 
-        popup.deactivate_update = lambda: update_item.set_sensitive(False)
-        popup.activate_update = lambda: update_item.set_sensitive(True)
+        popup.set_update_sensitive = update_item.set_sensitive
         popup.append(update_item)
         popup.append(mark_item)
         popup.show_all()
         return popup
 
     def update_view_all(self):
-        it = self.model.get_iter_first()
-        while (it):
-            itc = self.model.iter_children(it)
-            while (itc):
-                feedurl = self.model.get_value(itc, 0)
-                feed = self.feeddb.get_feed(feedurl)
-                title = markup_escape_text(feed['title'])
-                unread = feed['unread']
-                if unread > 0:
-                    title = "<b>"+title+" (%d)"%unread+"</b>"
-                self.model.set_value(itc, 1, title)
-                itc = self.model.iter_next(itc)
-            it = self.model.iter_next(it)
+        for feedurl in self.rows:
+            self.update_view(feedurl)
 
     def update_view(self, feedurl):
-        it = self.model.get_iter_first()
-        feed_iter = None
-        while (it) and not feed_iter:
-            itc = self.model.iter_children(it)
-            while (itc) and not feed_iter:
-                if self.model.get_value(itc, 0) == feedurl:
-                    feed_iter = itc
-                itc = self.model.iter_next(itc)
-            it = self.model.iter_next(it)
-        feed = self.feeddb.get_feed(feedurl)
-        title = markup_escape_text(feed['title'])
-        unread = feed['unread']
-        if unread > 0:
-            title = "<b>"+title+" (%d)"%unread+"</b>"
-        self.model.set_value(feed_iter, 1, title)
+        it = self.feed_iter(feedurl)
+        if not it:
+            return
+        self.model.set_value(it, 1, self.feed_label(self.feeddb.get_feed(feedurl)))
+        self.update_counts(feedurl)
 
     def update_feed_all(self):
+        self.update_feeds(list(self.iter_feeds()))
+
+    def update_feed_due(self):
+        """
+        update all feeds whose polling interval has passed
+        once they are done, update_feed_done arms the timer for the next one
+        """
+        self.due_source = None
+        if not self.updating:
+            schedule = self.feeddb.get_schedule_all()
+            now = time.time()
+            self.update_feeds([self.feed_iter(feedurl) for feedurl in self.rows
+                if schedule.get(feedurl, 0) <= now])
+        if not self.updating:
+            self.schedule_updates()
+        return False
+
+    def schedule_updates(self):
+        """
+        arm a timer that fires when the next feed is due
+        """
+        if self.due_source:
+            GLib.source_remove(self.due_source)
+        schedule = self.feeddb.get_schedule_all()
+        nextdue = min([schedule.get(feedurl, 0) for feedurl in self.rows]
+            or [time.time()+fetcher.DEFAULT_INTERVAL])
+        # do not wake up more than once per minute
+        delay = max(nextdue - time.time(), 60)
+        self.due_source = GLib.timeout_add_seconds(int(delay), self.update_feed_due)
+
+    def update_feeds(self, iters):
+        if not iters: return
+
         self.emit("refresh-begin")
 
         # disable updating via context menu
-        self.disable_context_update()
-
-        it = self.model.get_iter_first()
-        while (it):
-            # add feedurls to self.updating so that each feed can remove itself
-            # from it once it is done and the last feed knows to take cleanup
-            # actions
-            itc = self.model.iter_children(it)
-            while (itc):
-                self.updating.add(self.model.get_value(itc, 0))
-                itc = self.model.iter_next(itc)
-
-            itc = self.model.iter_children(it)
-            while (itc):
-                self.update_feed(itc)
-                itc = self.model.iter_next(itc)
-            it = self.model.iter_next(it)
+        self.set_update_sensitive(False)
+
+        # add feedurls to self.updating so that each feed can remove itself
+        # from it once it is done and the last feed knows to take cleanup
+        # actions
+        for itc in iters:
+            self.updating.add(self.model.get_value(itc, 0))
+
+        for itc in iters:
+            self.update_feed(itc)
 
     def update_feed_done(self, feedurl):
         self.updating.remove(feedurl)
         if self.updating: return
 
+        # wait for the next feed that is due
+        self.schedule_updates()
+
         # enable updating via context menu
-        it = self.model.get_iter_first()
-        while (it):
-            itc = self.model.iter_children(it)
-            while (itc):
-                self.model.get_value(itc, 3).activate_update()
-                itc = self.model.iter_next(itc)
-            it = self.model.iter_next(it)
-        # enable updating
+        self.set_update_sensitive(True)
         self.emit("refresh-complete")
 
-    def update_feed(self, it):
+    def update_feed(self, it, priority=fetcher.PRIORITY_NORMAL):
         error_icon = self.render_icon(Gtk.STOCK_DIALOG_ERROR, Gtk.IconSize.MENU, None)
         feedurl = self.model.get_value(it, 0)
-        msg = Soup.Message.new("GET", feedurl)
-        feed = self.feeddb.get_feed(feedurl)
-        if feed.get('etag'):
-            msg.request_headers.append('If-None-Match', feed['etag'])
-        if feed.get('lastmodified'):
-            msg.request_headers.append('If-Modified-Since', feed['lastmodified'])
 
-        def complete_cb(session, msg, it):
-            if msg.status_code not in [200, 304]:
+        def done_cb(feedurl, result):
+            if result['status'] == 'error':
                 self.model.set_value(it, 2, error_icon)
                 self.update_feed_done(feedurl)
                 return
 
-            # get existing feedentry or create new one
             entry = self.feeddb.get_feed(feedurl)
 
-            if entry.get('favicon'):
-                icon = pixbuf_new_from_file_in_memory(entry['favicon'], (16, 16)) or error_icon
+            if result['status'] == 'invalid':
+                icon = error_icon
             else:
-                icon = self.render_icon(Gtk.STOCK_FILE, Gtk.IconSize.MENU, None)
+                icon = self.feed_icon(entry)
             self.model.set_value(it, 2, icon)
 
-            if msg.status_code == 304:
-                self.update_feed_done(feedurl)
-                return
-
-            # filling default values
-            if not entry.has_key('unread'):
-                entry['unread'] = 0
-            if not entry.has_key('items'):
-                entry['items'] = dict()
-
-            # updating etag and lastmodified
-            if msg.response_headers.get_one('ETag'):
-                entry['etag'] = msg.response_headers.get_one('ETag')
-            if msg.response_headers.get_one('Last-Modified'):
-                entry['lastmodified'] = msg.response_headers.get_one('Last-Modified')
-
-            try:
-                feedparse = feedparser.parse(msg.response_body.flatten().get_data())
-            except:
-                print "error parsing feed:", feedurl
-                print msg.response_body.flatten().get_data().encode('base64_codec')
-                self.model.set_value(it, 2, error_icon)
-                self.update_feed_done(feedurl)
-                return
-
-            if feedparse.bozo != 0:
-                # retrieved data was no valid feed
-                self.model.set_value(it, 2, error_icon)
-                self.update_feed_done(feedurl)
-                return
-
-            entry['title'] = feedparse.feed.get('title')
-            self.model.set_value(it, 1, markup_escape_text(entry['title']))
-
-            # assumption: favicon never changes
-            if not entry.has_key('favicon'):
+            # look for the icon of new feeds and check the known ones once
+            # in a while
+            if result['status'] != 'invalid' and (result['newfeed'] or self.updater.icon_due(feedurl)):
                 self.updating.add(feedurl+"_icon")
                 self.update_icon(it, feedurl)
 
-            for item in feedparse.entries:
-                # use guid with fallback to link as identifier
-                itemid = item.get("id", item.get("link"))
-                if not itemid:
-                    # TODO: display error "cannot identify feeditems"
-                    break
-
-                if self.feeddb.get_entry(feedurl, itemid):
-                    # already exists
-                    continue
-
-                new_item = {
-                    'link': item.get('link'),
-                    'title': item.get('title'),
-                    'date': item.get('published_parsed'),
-                    'content': item.get('content'),
-                    'categories': ','.join([cat for _, cat in item.get('categories', [])]) or "",
-                    'unread': True
-                }
-
-                if not new_item['date']:
-                    new_item['date'] = item.get('updated_parsed')
-
-                if new_item['date']:
-                    new_item['date'] = int(time.mktime(new_item['date']))
-                else:
-                    new_item['date'] = int(time.time())
-
-                if new_item['content']:
-                    new_item['content'] = new_item['content'][0]
-                else:
-                    new_item['content'] = item.get('summary_detail')
-
-                if new_item['content']:
-                    new_item['content'] = new_item['content']['value']
-                else:
-                    new_item['content'] = ""
-
-                self.feeddb.add_entry(feedurl, itemid, new_item)
-
-                entry['unread'] += 1
-
-            if entry['unread'] > 0:
-                self.model.set_value(it, 1, '<b>'+markup_escape_text(entry['title'])+" (%d)"%entry['unread']+'</b>')
+            if result['status'] != 'updated':
+                self.update_feed_done(feedurl)
+                return
 
-            self.feeddb.update_feed(feedurl, entry)
+            self.model.set_value(it, 1, self.feed_label(entry))
+            self.update_counts(feedurl)
 
-            self.emit("update-feed", feedurl)
+            if result['new']:
+                self.emit("entries-added", feedurl, result['new'])
 
             self.update_feed_done(feedurl)
-        self.session.queue_message(msg, complete_cb, it)
+        self.updater.update(feedurl, done_cb, priority)
 
     def update_icon(self, it, feedurl):
-        msg = Soup.Message.new("GET", feedurl)
-        def complete_cb(session, msg, it):
-            if msg.status_code == 200:
-                icon_url = find_shortcut_icon_link_in_html(msg.response_body.flatten().get_data())
-                if icon_url:
-                    icon_url = urljoin(feedurl, icon_url)
-                    self.update_icon_link(it, feedurl, icon_url)
-                else:
-                    self.update_icon_favicon(it, feedurl)
-            else:
-                self.update_icon_favicon(it, feedurl)
-        self.session.queue_message(msg, complete_cb, it)
+        def done_cb(feedurl, faviconhash):
+            self.model.set_value(it, 2, self.feed_icon(self.feeddb.get_feed(feedurl)))
+            self.update_feed_done(feedurl+"_icon")
+        self.updater.update_icon(feedurl, done_cb)
 
-    # get shortcut icon from link rel
-    def update_icon_link(self, it, feedurl, url):
-        error_icon = self.render_icon(Gtk.STOCK_DIALOG_ERROR, Gtk.IconSize.MENU, None)
-        msg = Soup.Message.new("GET", url)
-        def complete_cb(session, msg, it):
-            if msg.status_code == 200:
-                data = msg.response_body.flatten().get_data()
-                if len(data):
-                    icon = pixbuf_new_from_file_in_memory(data, (16, 16)) or error_icon
-                    self.feeddb.set_favicon(feedurl, data)
-                    self.model.set_value(it, 2, icon)
-                    self.update_feed_done(feedurl)
-                else:
-                    self.update_icon_favicon(it, feedurl)
-            else:
-                self.update_icon_favicon(it, feedurl)
-        self.session.queue_message(msg, complete_cb, it)
 
-    # get /favicon.ico
-    def update_icon_favicon(self, it, feedurl):
-        error_icon = self.render_icon(Gtk.STOCK_DIALOG_ERROR, Gtk.IconSize.MENU, None)
-        url = urlparse(feedurl)
-        url = urlunparse((url.scheme, url.netloc, 'favicon.ico', '', '', ''))
-        msg = Soup.Message.new("GET", url)
-        def complete_cb(session, msg, it):
-            data = None
-            if msg.status_code == 200:
-                data = msg.response_body.flatten().get_data()
-                if len(data):
-                    icon = pixbuf_new_from_file_in_memory(data, (16, 16)) or error_icon
-                else:
-                    icon = self.render_icon(Gtk.STOCK_FILE, Gtk.IconSize.MENU, None)
-            else:
-                icon = self.render_icon(Gtk.STOCK_FILE, Gtk.IconSize.MENU, None)
-            self.feeddb.set_favicon(feedurl, data)
-            self.model.set_value(it, 2, icon)
-            self.update_feed_done(feedurl+"_icon")
-        self.session.queue_message(msg, complete_cb, it)
+class FetchStatsDialog(Gtk.Dialog):
+    """
+    shows where the time of the last refresh run went and the averages of
+    each feed over the runs kept in the fetch_stats table
+    """
+    def __init__(self, parent, feeddb):
+        Gtk.Dialog.__init__(self, _("Update Statistics"), parent, 0,
+            (Gtk.STOCK_CLOSE, Gtk.ResponseType.CLOSE))
+        self.set_default_size(700, 400)
+
+        run = feeddb.get_run_stats()
+        label = Gtk.Label()
+        label.set_alignment(0, 0.5)
+        if run:
+            label.set_text(_("Last update %s: %d feeds, %d not modified, %d failed, %.1f KiB, %d new entries\n"
+                "%.1f s resolving, %.1f s connecting, %.1f s waiting, %.1f s transferring, %.1f s parsing, %.1f s storing")%(
+                get_time_pretty(run['run']), run['feeds'], run['notmodified'], run['errors'], run['bytes']/1024,
+                run['new'], run['dns'], run['connect'], run['wait'], run['transfer'], run['parse'], run['store']))
+        else:
+            label.set_text(_("No feeds were updated yet"))
+
+        # feed, fetches, not modified in percent, KiB, network, parse and
+        # store time in milliseconds
+        model = Gtk.ListStore(str, int, float, float, float, float, float)
+        for row in feeddb.get_feed_stats():
+            feed = feeddb.get_feed(row['feed'])
+            network = sum(row[key] or 0 for key in ['dns', 'connect', 'wait', 'transfer'])
+            model.append([feed.get('title') or row['feed'], row['fetches'], 100.0*row['notmodified']/row['fetches'],
+                (row['bytes'] or 0)/1024, network*1000, (row['parse'] or 0)*1000, (row['store'] or 0)*1000])
+
+        def format_cb(column, cell, model, it, n):
+            cell.set_property("text", "%.0f"%model.get_value(it, n))
+        treeview = Gtk.TreeView(model)
+        for n, title in enumerate([_("Feed"), _("Updates"), _("Not Modified %"), _("KiB"),
+                _("Network ms"), _("Parse ms"), _("Store ms")]):
+            renderer = Gtk.CellRendererText()
+            column = Gtk.TreeViewColumn(title, renderer, text=n)
+            if n == 0:
+                renderer.set_property("ellipsize", Pango.EllipsizeMode.END)
+                column.set_expand(True)
+            elif n > 1:
+                column.set_cell_data_func(renderer, format_cb, n)
+            column.set_sort_column_id(n)
+            treeview.append_column(column)
+
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+        scrolled.add(treeview)
+
+        area = self.get_content_area()
+        area.pack_start(label, False, False, 6)
+        area.pack_start(scrolled, True, True, 0)
+
+        def response_cb(dialog, response):
+            dialog.destroy()
+        self.connect("response", response_cb)
+        self.show_all()
 
 
 class FeedReaderWindow(Gtk.Window):
-    def __init__(self):
+    def __init__(self, options, parsepool, cache=None):
         Gtk.Window.__init__(self)
 
-        # try the following paths for pyferea.sqlite in this order
-        xdg_data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
-        feeddb_paths = [
-            "./pyferea.sqlite",
-            os.path.join(xdg_data_home, "pyferea", "pyferea.sqlite"),
-        ]
-        feeddb = None
-        for path in feeddb_paths:
-            if os.path.exists(path):
-                feeddb = sqlite_db.SQLStorage(path)
-                break
-        if not feeddb:
-            print "cannot find pyferea.sqlite in any of the following locations:"
-            for path in feeddb_paths:
-                print path
-            print "creating new db at %s"%feeddb_paths[0]
-            feeddb = sqlite_db.SQLStorage(feeddb_paths[0])
-
-        # try the following paths for feeds.yaml in this order
-        xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
-        feeds_paths = [
-            "./feeds.yaml",
-            os.path.join(xdg_config_home, "pyferea", "feeds.yaml"),
-            "/usr/share/pyferea/feeds.yaml.example"
-        ]
-        conig = None
-        for path in feeds_paths:
-            if os.path.exists(path):
-                with open(path) as f:
-                    config = yaml.load(f)
-                break
-        if not config:
-            print "cannot find feeds.yaml in any of the following locations:"
-            for path in feeds_paths:
-                print path
-            exit(1)
+        feeddb = feedconfig.open_feeddb()
+        config = feedconfig.load_config()
 
         toolbar = WebToolbar()
 
@@ -1040,12 +1208,38 @@ class FeedReaderWindow(Gtk.Window):
             toolbar.show_hover_uri(uri)
         content_pane.connect("hover-link-changed", hover_link_changed_cb)
 
-        entries = EntryTree(config, feeddb)
+        entries = EntryTree(feeddb)
 
-        def item_selected_cb(entry, feedurl, item):
-            item = feeddb.get_entry(feedurl, item)
-            if config[feedurl]['loadlink']:
-                content_pane.load_uri(item['link'])
+        # the archive has its own session so that its downloads neither
+        # count towards the refresh progress nor hold up feed downloads
+        archive_session = Soup.SessionAsync.new()
+        archive_session.add_feature(Soup.ContentDecoder())
+        archive_session.set_property("timeout", 60)
+        archive = archiver.Archiver(feeddb,
+            fetcher.FetchScheduler(archive_session, options.archive_connections, 1),
+            feedconfig.data_dir("archive"))
+
+        # downloading only helps if the responses end up in the http cache
+        if cache and not options.no_prefetch_network:
+            per_entry = 2
+        else:
+            per_entry = 0
+        prefetch = prefetcher.Prefetcher(feeddb, WebKit.get_default_session(), config, archive, per_entry)
+        self.prefetch_source = None
+        def prefetch_cb():
+            self.prefetch_source = None
+            prefetch.prefetch(entries.upcoming(options.prefetch))
+            return False
+
+        def item_selected_cb(entry, feedurl, itemid):
+            item = prefetch.get_entry(feedurl, itemid)
+            if config.get(feedurl, {}).get('loadlink'):
+                path = archive.path(feedurl, itemid)
+                if path:
+                    content_pane.load_uri("file://"+urllib.pathname2url(path))
+                    toolbar.location_set_text(item['link'])
+                else:
+                    content_pane.load_uri(item['link'])
             else:
                 if item.get('categories'):
                     content_string = "<h1>%s</h1><p>%s</p>"%(item['title'], ', '.join(item['categories']))
@@ -1055,35 +1249,72 @@ class FeedReaderWindow(Gtk.Window):
                 toolbar.location_set_text(item['link'])
                 self.set_title(_("PyFeRea - %s")%item['title'])
             feedtree.update_view(feedurl)
+            # leave the network to the selected entry for a moment and
+            # forget about the upcoming entries of the last selection
+            prefetch.cancel()
+            if self.prefetch_source:
+                GLib.source_remove(self.prefetch_source)
+                self.prefetch_source = None
+            if options.prefetch > 0:
+                self.prefetch_source = GLib.timeout_add(250, prefetch_cb)
         entries.connect("item-selected", item_selected_cb)
 
-        feedtree = FeedTree(config, feeddb)
+        feedtree = FeedTree(config, feeddb, parsepool,
+            options.max_connections, options.max_per_host,
+            None if options.no_icon_cache else feedconfig.cache_dir("icons"),
+            options.stop_after)
 
         def feed_selected_cb(feedtree, feedurl):
             entries.display(feedurl)
         feedtree.connect("feed-selected", feed_selected_cb)
 
-        def update_feed_cb(feedtree, feedurl):
-            entries.update(feedurl)
-        feedtree.connect("update-feed", update_feed_cb)
+        def entries_added_cb(feedtree, feedurl, new):
+            entries.entries_added(feedurl, new)
+            feedprops = config.get(feedurl, {})
+            if feedprops.get('loadlink') and feedprops.get('archive'):
+                archive.archive(feedurl, new)
+        feedtree.connect("entries-added", entries_added_cb)
+
+        def feed_marked_read_cb(feedtree, feedurl):
+            entries.feed_marked_read(feedurl)
+        feedtree.connect("feed-marked-read", feed_marked_read_cb)
 
         def refresh_begin_cb(feedtree):
             button_refresh.set_label(_("Updating..."))
             button_refresh.set_sensitive(False)
         feedtree.connect("refresh-begin", refresh_begin_cb)
+        def refresh_progress_cb(feedtree, done, total):
+            button_refresh.set_label(_("Updating... (%d/%d)")%(done, total))
+        feedtree.connect("refresh-progress", refresh_progress_cb)
+        # delete old entries in small steps so that the gui stays responsive
+        self.pruning = None
+        def prune_cb():
+            policies = feedconfig.retention_policies(config)
+            if self.pruning or not policies:
+                return
+            self.pruning = feeddb.prune(policies)
+            pruned = [0]
+            def step():
+                for feedurl, deleted in self.pruning:
+                    entries.update(feedurl)
+                    pruned[0] += deleted
+                    return True
+                self.pruning = None
+                # the archived pages of the pruned entries are not needed
+                # anymore, unless the archive is still busy
+                if pruned[0] and not archive.scheduler.in_flight():
+                    deleted, size = archiver.sweep(feeddb, archive.store)
+                    log.info("deleted %d archived files, %.1f MiB", deleted, size/1048576.0)
+                return False
+            GLib.idle_add(step, priority=GLib.PRIORITY_LOW)
+
         def refresh_complete_cb(feedtree):
             button_refresh.set_label(_("Update All"))
             button_refresh.set_sensitive(True)
+            feeddb.trim_fetch_stats()
+            prune_cb()
         feedtree.connect("refresh-complete", refresh_complete_cb)
 
-        def timeout_cb(foo):
-            if feedtree.updating: return True
-            feedtree.update_feed_all()
-            #from meliae import scanner
-            #scanner.dump_all_objects('filename.json')
-            return True
-        GLib.timeout_add_seconds(3600, timeout_cb, None)
-
         button_refresh = Gtk.Button()
         button_refresh.set_image(Gtk.Image.new_from_stock(Gtk.STOCK_REFRESH, Gtk.IconSize.MENU))
         button_refresh.set_label(_("Update All"))
@@ -1097,17 +1328,49 @@ class FeedReaderWindow(Gtk.Window):
         def mark_all_cb(button):
             feedtree.mark_read_all()
         button_mark_all.connect("clicked", mark_all_cb)
+        def unread_changed_cb(feedtree, unread):
+            if unread > 0:
+                button_mark_all.set_label(_("Mark All As Read (%d)")%unread)
+            else:
+                button_mark_all.set_label(_("Mark All As Read"))
+        feedtree.connect("unread-changed", unread_changed_cb)
+        feedtree.update_counts()
+
+        button_stats = Gtk.Button()
+        button_stats.set_image(Gtk.Image.new_from_stock(Gtk.STOCK_INFO, Gtk.IconSize.MENU))
+        button_stats.set_tooltip_text(_("Update Statistics"))
+        def stats_cb(button):
+            FetchStatsDialog(self, feeddb)
+        button_stats.connect("clicked", stats_cb)
 
         hbox = Gtk.HBox()
         hbox.pack_start(button_refresh, False, False, 0)
         hbox.pack_start(button_mark_all, False, False, 0)
+        hbox.pack_start(button_stats, False, False, 0)
 
         scrolled_feedtree = Gtk.ScrolledWindow()
         scrolled_feedtree.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
         scrolled_feedtree.add(feedtree)
 
         vbox2 = Gtk.VBox()
+        search_entry = Gtk.Entry()
+        search_entry.set_placeholder_text(_("Search"))
+        search_entry.set_icon_from_stock(Gtk.EntryIconPosition.PRIMARY, Gtk.STOCK_FIND)
+        def search_activate_cb(entry):
+            query = entry.get_text()
+            if query.strip():
+                entries.display_search(query)
+            else:
+                # go back to the selected feed
+                _, it = feedtree.get_selection().get_selected()
+                entries.display(feedtree.model.get_value(it, 0) if it else None)
+        search_entry.connect("activate", search_activate_cb)
+        if not feeddb.fts:
+            search_entry.set_sensitive(False)
+            search_entry.set_tooltip_text(_("Searching needs sqlite with fts5"))
+
         vbox2.pack_start(hbox, False, False, 0)
+        vbox2.pack_start(search_entry, False, False, 0)
         vbox2.pack_start(scrolled_feedtree, True, True, 0)
 
         scrolled_entries = Gtk.ScrolledWindow()
@@ -1130,7 +1393,13 @@ class FeedReaderWindow(Gtk.Window):
         self.set_default_size(800, 600)
 
         def destroy_cb(window):
+            parsepool.close()
             feeddb.close()
+            if cache:
+                cache.close()
+                stats = cache.stats()
+                log.info("http cache: %d hits, %d revalidated, %d misses, %.0f%% hit rate",
+                    stats['hits'], stats['revalidated'], stats['misses'], stats['hitrate']*100)
             self.destroy()
             Gtk.main_quit()
         self.connect('destroy', destroy_cb)
@@ -1148,18 +1417,54 @@ class FeedReaderWindow(Gtk.Window):
             return False
         self.connect('key-press-event', key_press_event)
 
-        feedtree.update_feed_all()
+        # update all feeds that are due and poll the others once they are
+        feedtree.update_feed_due()
 
         self.show_all()
 
         content_pane.new_tab()
 
 if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--parse-workers", type="int", default=0, metavar="N",
+        help="number of processes parsing feeds (default: number of cpus)")
+    parser.add_option("--max-connections", type="int", default=8, metavar="N",
+        help="maximum number of concurrent feed downloads (default: 8)")
+    parser.add_option("--max-per-host", type="int", default=2, metavar="N",
+        help="maximum number of concurrent downloads per host (default: 2)")
+    parser.add_option("--stop-after", type="int", default=10, metavar="N",
+        help="stop downloading a feed once N entries in a row are known already, 0 always downloads whole feeds (default: 10)")
+    parser.add_option("--no-icon-cache", action="store_true", default=False,
+        help="do not keep scaled feed icons in $XDG_CACHE_HOME/pyferea/icons")
+    parser.add_option("--archive-connections", type="int", default=4, metavar="N",
+        help="maximum number of concurrent downloads for the offline archive (default: 4)")
+    parser.add_option("--http-cache-size", type="int", default=50, metavar="MIB",
+        help="size of the http cache of the browser in $XDG_CACHE_HOME/pyferea/http, 0 disables it (default: 50)")
+    parser.add_option("--prefetch", type="int", default=3, metavar="N",
+        help="number of entries after the selected one to prepare, 0 disables prefetching (default: 3)")
+    parser.add_option("--no-prefetch-network", action="store_true", default=False,
+        help="only read the upcoming entries from the database but do not download their pages or images, for example on metered connections")
+    parser.add_option("--verbose", action="store_true", default=False,
+        help="log what is being updated and downloaded")
+    parser.add_option("--debug", action="store_true", default=False,
+        help="log every database access, implies --verbose")
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO if options.verbose else logging.WARNING,
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    # the parse workers deliver their results from a helper thread
+    GObject.threads_init()
+    # fork the parse workers before webkit and soup start their own threads
+    parsepool = feedworker.ParsePool(options.parse_workers, GLib.idle_add)
     jar = Soup.CookieJarText.new("cookies.txt", False)
     cd = Soup.ContentDecoder()
     session = WebKit.get_default_session()
     session.add_feature(jar)
     session.add_feature(cd)
     session.set_property("timeout", 60)
-    feedreader = FeedReaderWindow()
+    if options.http_cache_size > 0:
+        cache = httpcache.HttpCache(session, feedconfig.cache_dir("http"), options.http_cache_size*1024*1024)
+    else:
+        cache = None
+    feedreader = FeedReaderWindow(options, parsepool, cache)
     Gtk.main()
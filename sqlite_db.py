@@ -1,7 +1,19 @@
 import sqlite3
+import hashlib
+import logging
+import re
+import time
+import zlib
+from collections import OrderedDict
+from HTMLParser import HTMLParser
 
+log = logging.getLogger(__name__)
 
-def dbcreate(conn):
+
+def migration_1(conn):
+    """
+    the initial schema
+    """
     conn.execute("""
     CREATE TABLE IF NOT EXISTS feeds (
     feed TEXT NOT NULL,
@@ -29,7 +41,341 @@ def dbcreate(conn):
     conn.execute("""
     CREATE UNIQUE INDEX IF NOT EXISTS entridx ON entries (feed,entry)
     """)
+
+def migration_2(conn):
+    """
+    settings and polling schedule
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS settings (
+    name TEXT NOT NULL PRIMARY KEY,
+    value TEXT
+    )""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schedule (
+    feed TEXT NOT NULL PRIMARY KEY,
+    interval INTEGER,
+    nextdue INTEGER,
+    mininterval INTEGER,
+    skiphours TEXT
+    )""")
+
+def migration_3(conn):
+    """
+    index for listing the entries of a feed by date without sorting
+    """
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS entrydateidx ON entries (feed,date)
+    """)
+
+def migration_4(conn):
+    """
+    small index over the unread entries only, queries have to use the
+    literal condition unread=1 for sqlite to pick it
+    """
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS entryunreadidx ON entries (feed) WHERE unread=1
+    """)
+
+def migration_5(conn):
+    """
+    starred entries are never pruned
+    """
+    conn.execute("""
+    ALTER TABLE entries ADD COLUMN starred INTEGER NOT NULL DEFAULT 0
+    """)
+
+def migration_6(conn):
+    """
+    move the favicons out of the feeds table, so that reading a feed row
+    does not read its icon, and store each distinct icon once
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS favicons (
+    hash TEXT NOT NULL PRIMARY KEY,
+    data BLOB
+    )""")
+    conn.execute("""
+    ALTER TABLE feeds ADD COLUMN faviconhash TEXT
+    """)
+    for feed, favicon in conn.execute("""SELECT feed, favicon FROM feeds WHERE favicon IS NOT NULL""").fetchall():
+        favicon = str(favicon)
+        faviconhash = hashlib.sha1(favicon).hexdigest()
+        conn.execute("""INSERT OR IGNORE INTO favicons (hash, data) VALUES (?, ?)""", (faviconhash, sqlite3.Binary(favicon)))
+        conn.execute("""UPDATE feeds SET faviconhash=? WHERE feed=?""", (faviconhash, feed))
+    conn.execute("""UPDATE feeds SET favicon=NULL""")
+
+def migration_7(conn):
+    """
+    let triggers keep the unread counters of the feeds up to date. the
+    total in counters is kept by the same triggers independently of the
+    feed rows, so that check_unread can compare the two
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS counters (
+    name TEXT NOT NULL PRIMARY KEY,
+    value INTEGER NOT NULL
+    )""")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS entries_unread_insert AFTER INSERT ON entries WHEN NEW.unread=1
+    BEGIN
+        UPDATE feeds SET unread=unread+1 WHERE feed=NEW.feed;
+        UPDATE counters SET value=value+1 WHERE name='unread';
+    END""")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS entries_unread_delete AFTER DELETE ON entries WHEN OLD.unread=1
+    BEGIN
+        UPDATE feeds SET unread=unread-1 WHERE feed=OLD.feed;
+        UPDATE counters SET value=value-1 WHERE name='unread';
+    END""")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS entries_unread_update AFTER UPDATE OF unread ON entries
+    WHEN (OLD.unread=1) <> (NEW.unread=1)
+    BEGIN
+        UPDATE feeds SET unread=unread+(CASE WHEN NEW.unread=1 THEN 1 ELSE -1 END) WHERE feed=NEW.feed;
+        UPDATE counters SET value=value+(CASE WHEN NEW.unread=1 THEN 1 ELSE -1 END) WHERE name='unread';
+    END""")
+    # the counters maintained by hand might have drifted, start over
+    conn.execute("""
+    UPDATE feeds SET unread=(SELECT COUNT(*) FROM entries WHERE entries.feed=feeds.feed AND unread=1)
+    """)
+    conn.execute("""
+    INSERT OR REPLACE INTO counters (name, value) SELECT 'unread', COUNT(*) FROM entries WHERE unread=1
+    """)
+
+def migration_8(conn):
+    """
+    the homepage of each feed, where its icon is looked for, and the icons
+    found per host so that feeds of the same site share them
+    """
+    conn.execute("""
+    ALTER TABLE feeds ADD COLUMN homepage TEXT
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS hosticons (
+    host TEXT NOT NULL PRIMARY KEY,
+    iconurl TEXT,
+    faviconhash TEXT,
+    etag TEXT,
+    lastmodified TEXT,
+    checked INTEGER
+    )""")
+
+def migration_9(conn):
+    """
+    the archived copies of the linked pages of entries
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS archive (
+    feed TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    path TEXT NOT NULL,
+    archived INTEGER,
+    PRIMARY KEY (feed, entry)
+    )""")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS entries_archive_delete AFTER DELETE ON entries
+    BEGIN
+        DELETE FROM archive WHERE feed=OLD.feed AND entry=OLD.entry;
+    END""")
+
+def migration_10(conn):
+    """
+    the parser backend that handled the last document of each feed
+    """
+    conn.execute("""
+    ALTER TABLE feeds ADD COLUMN parser TEXT
+    """)
+
+def migration_11(conn):
+    """
+    where the time of each feed update went, kept for the last few refresh
+    runs. durations are in seconds and NULL if the phase did not happen
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS fetch_stats (
+    feed TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    status TEXT,
+    httpstatus INTEGER,
+    parser TEXT,
+    bytes INTEGER,
+    dns REAL,
+    connect REAL,
+    wait REAL,
+    transfer REAL,
+    parse REAL,
+    store REAL,
+    new INTEGER
+    )""")
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS fetch_stats_run ON fetch_stats (run)
+    """)
+
+def migration_12(conn):
+    """
+    the ids of pruned entries that the feed document still lists, so that
+    they are not stored again as new unread entries
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS pruned (
+    feed TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (feed, entry)
+    )""")
+
+def migration_13(conn):
+    """
+    the full text index was filled with text in which the html entities of
+    non-ascii content were not decoded. the index might not exist yet and
+    is filled by SQLStorage, so only ask for it to be rebuilt
+    """
+    conn.execute("""
+    REPLACE INTO settings (name, value) VALUES ('fts_stale', '1')
+    """)
+
+def migration_14(conn):
+    """
+    when the lxml backend last failed on each feed, so that it is tried
+    again after a while instead of using feedparser for good
+    """
+    conn.execute("""
+    ALTER TABLE feeds ADD COLUMN fallback INTEGER
+    """)
+
+# the schema version stored in PRAGMA user_version is the number of
+# migrations applied. only ever append to this list.
+MIGRATIONS = [
+    migration_1,
+    migration_2,
+    migration_3,
+    migration_4,
+    migration_5,
+    migration_6,
+    migration_7,
+    migration_8,
+    migration_9,
+    migration_10,
+    migration_11,
+    migration_12,
+    migration_13,
+    migration_14,
+]
+
+def dbcreate(conn):
+    """
+    bring the schema up to date by running all migrations that were not
+    applied yet, each in its own transaction
+    """
+    version = conn.execute("""PRAGMA user_version""").fetchone()[0]
+    isolation_level = conn.isolation_level
+    # manage transactions ourselves, the sqlite3 module would commit
+    # before every CREATE statement
+    conn.isolation_level = None
+    try:
+        for number, migration in enumerate(MIGRATIONS[version:], version+1):
+            start = time.time()
+            conn.execute("""BEGIN""")
+            try:
+                migration(conn)
+                conn.execute("""PRAGMA user_version=%d"""%number)
+            except:
+                conn.execute("""ROLLBACK""")
+                raise
+            conn.execute("""COMMIT""")
+            log.info("migrated database to version %d in %.3f seconds", number, time.time()-start)
+    finally:
+        conn.isolation_level = isolation_level
+
+def connect(filename):
+    """
+    open a connection to filename tuned for pyferea
+    """
+    conn = sqlite3.connect(filename)
+    conn.text_factory = str
+    # lets pruning give space back to the file system. this only has an
+    # effect on new databases, existing ones need SQLStorage.vacuum
+    conn.execute("""PRAGMA auto_vacuum=INCREMENTAL""")
+    # readers (the gui) and a writer (the headless fetcher) do not block
+    # each other and commits do not wait for the disk in WAL mode
+    conn.execute("""PRAGMA journal_mode=WAL""")
+    conn.execute("""PRAGMA synchronous=NORMAL""")
+    conn.execute("""PRAGMA mmap_size=268435456""")
+    # in KiB
+    conn.execute("""PRAGMA cache_size=-16384""")
+    return conn
+
+def ftscreate(conn):
+    """
+    create the full text index of the entries
+    returns whether the index was newly created or None if sqlite was built
+    without fts5
+    """
+    exists = conn.execute("""SELECT 1 FROM sqlite_master WHERE name='entries_fts'""").fetchone()
+    if exists:
+        return False
+    try:
+        # the rowids are the ones of the entries table
+        conn.execute("""
+        CREATE VIRTUAL TABLE entries_fts USING fts5 (
+        title,
+        content,
+        categories
+        )""")
+    except sqlite3.OperationalError:
+        log.warning("no fts5 support in sqlite, searching is disabled")
+        return None
     conn.commit()
+    return True
+
+_html_tag_re = re.compile(r'<(script|style)\b.*?</\1\s*>|<!--.*?-->|<[^>]*>', re.S|re.I)
+_html_parser = HTMLParser()
+
+def strip_html(html):
+    """
+    returns the text of a html fragment for the full text index
+    """
+    if not html:
+        return ""
+    text = _html_tag_re.sub(' ', html)
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return _html_parser.unescape(text)
+
+def fts_query(query):
+    """
+    turn what the user typed into a fts5 query matching entries that contain
+    all the given words, without interpreting any fts5 syntax
+    """
+    return ' '.join('"%s"'%word.replace('"', '""') for word in query.split())
+
+# compressed content is stored as a blob starting with this marker, which
+# cannot start any html text
+ZLIB_MARKER = '\x00zlib\x00'
+
+def compress_content(content):
+    """
+    returns content compressed for storage unless that does not save space
+    """
+    if not content:
+        return content
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    compressed = ZLIB_MARKER+zlib.compress(content, 6)
+    if len(compressed) >= len(content):
+        return content
+    return sqlite3.Binary(compressed)
+
+def decompress_content(content):
+    """
+    returns the text of content as stored by compress_content
+    """
+    if content is None:
+        return None
+    content = str(content)
+    if content.startswith(ZLIB_MARKER):
+        return zlib.decompress(content[len(ZLIB_MARKER):])
+    return content
 
 def convert(filename):
     conn = sqlite3.connect(filename)
@@ -38,8 +384,12 @@ def convert(filename):
     import shelve
     feeddb = shelve.open("pyferea.db")
     for feed, fvalues in feeddb.items():
-        conn.execute("""REPLACE INTO feeds (feed, title, favicon, etag, lastmodified, unread) VALUES (?,?,?,?,?,?)""",
-        (feed, fvalues.get('title'), fvalues.get('favicon'), fvalues.get('etag'), fvalues.get('lastmodified'), fvalues.get('unread')))
+        favicon = fvalues.get('favicon')
+        faviconhash = hashlib.sha1(favicon).hexdigest() if favicon else None
+        if faviconhash:
+            conn.execute("""INSERT OR IGNORE INTO favicons (hash, data) VALUES (?, ?)""", (faviconhash, sqlite3.Binary(favicon)))
+        conn.execute("""REPLACE INTO feeds (feed, title, faviconhash, etag, lastmodified, unread) VALUES (?,?,?,?,?,?)""",
+        (feed, fvalues.get('title'), faviconhash, fvalues.get('etag'), fvalues.get('lastmodified'), 0))
         for entry, evalues in fvalues['items'].items():
             conn.execute("""REPLACE INTO entries (feed, entry, title, content, link, date, unread, categories) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
             (feed, entry, evalues.get('title'), evalues.get('content'), evalues.get('link'), evalues.get('date'), evalues.get('unread'), ', '.join(evalues.get('categories') or [])))
@@ -47,30 +397,158 @@ def convert(filename):
     conn.close()
     feeddb.close()
 
+class KnownEntries():
+    """
+    the entry ids of recently updated feeds, including the pruned ones, so
+    that telling whether an entry was seen already needs no query
+    the ids of a feed are read from the database the first time they are
+    needed. once more than limit ids are held, the feeds that were not used
+    for the longest time are forgotten, except for the last one used
+    """
+    def __init__(self, conn, limit=100000):
+        self.conn = conn
+        self.limit = limit
+        # feed -> set of entry ids, the least recently used feed first
+        self.feeds = OrderedDict()
+        self.size = 0
+
+    def get(self, feed):
+        """
+        returns the set of ids of the stored and pruned entries of feed
+        """
+        ids = self.feeds.pop(feed, None)
+        if ids is None:
+            ids = set(entry for entry, in self.conn.execute(
+                """SELECT entry FROM entries WHERE feed=? UNION ALL SELECT entry FROM pruned WHERE feed=?""", (feed, feed)))
+            self.size += len(ids)
+        self.feeds[feed] = ids
+        self.evict()
+        return ids
+
+    def add(self, feed, entries):
+        ids = self.feeds.get(feed)
+        if ids is None:
+            # read from the database once the feed is needed again
+            return
+        size = len(ids)
+        ids.update(entries)
+        self.size += len(ids) - size
+        self.evict()
+
+    def forget(self, feed):
+        ids = self.feeds.pop(feed, None)
+        if ids is not None:
+            self.size -= len(ids)
+
+    def evict(self):
+        while self.size > self.limit and len(self.feeds) > 1:
+            feed, ids = self.feeds.popitem(last=False)
+            self.size -= len(ids)
+
 class SQLStorage():
-    def __init__(self, filename=':memory:'):
-        self.conn = sqlite3.connect(filename)
-        self.conn.text_factory = str
+    def __init__(self, filename=':memory:', known_limit=100000):
+        self.conn = connect(filename)
         dbcreate(self.conn)
+        # entry ids of recently updated feeds. an id in there is in the
+        # database, but one that is missing might have been added by
+        # another process since
+        self.known = KnownEntries(self.conn, known_limit)
+        # once enabled, all new content is stored compressed
+        self.compress = self.get_setting('compress') == 'zlib'
+        created = ftscreate(self.conn)
+        self.fts = created is not None or self.conn.execute(
+            """SELECT 1 FROM sqlite_master WHERE name='entries_fts'""").fetchone() is not None
+        if created or (self.fts and self.get_setting('fts_stale')):
+            self.fts_rebuild()
+            self.conn.execute("""DELETE FROM settings WHERE name='fts_stale'""")
+            self.conn.commit()
+
+    def fts_rebuild(self, batch=1000):
+        """
+        fill the full text index from all entries, batch entries at a time
+        """
+        log.debug("fts_rebuild")
+        self.conn.execute("""DELETE FROM entries_fts""")
+        last = 0
+        while True:
+            rows = self.conn.execute("""SELECT rowid, title, content, categories FROM entries WHERE rowid>? ORDER BY rowid LIMIT ?""", (last, batch)).fetchall()
+            if not rows:
+                break
+            self.conn.executemany("""INSERT INTO entries_fts (rowid, title, content, categories) VALUES (?, ?, ?, ?)""",
+                ((rowid, title, strip_html(decompress_content(content)), categories) for rowid, title, content, categories in rows))
+            self.conn.commit()
+            last = rows[-1][0]
+
+    def get_setting(self, name):
+        result = self.conn.execute("""SELECT value FROM settings WHERE name=?""", (name,)).fetchone()
+        return result[0] if result else None
+
+    def set_setting(self, name, value):
+        self.conn.execute("""REPLACE INTO settings (name, value) VALUES (?, ?)""", (name, value))
+        self.conn.commit()
+
+    def store_content(self, content):
+        if self.compress:
+            return compress_content(content)
+        return content
+
+    def compress_entries(self, batch=500):
+        """
+        enable compression of new content and compress the content of all
+        existing entries, batch entries per transaction
+        returns the number of bytes the content took before and after
+        """
+        log.debug("compress_entries")
+        self.set_setting('compress', 'zlib')
+        self.compress = True
+        before = after = 0
+        last = 0
+        while True:
+            rows = self.conn.execute("""SELECT rowid, content FROM entries WHERE rowid>? ORDER BY rowid LIMIT ?""", (last, batch)).fetchall()
+            if not rows:
+                break
+            updates = list()
+            for rowid, content in rows:
+                size = len(content or "")
+                before += size
+                if content is None or str(content).startswith(ZLIB_MARKER):
+                    after += size
+                    continue
+                content = compress_content(content)
+                after += len(content)
+                updates.append((content, rowid))
+            with self.conn:
+                self.conn.executemany("""UPDATE entries SET content=? WHERE rowid=?""", updates)
+            last = rows[-1][0]
+        return before, after
 
     def get_feed(self, feed):
-        print "get_feed"
-        result = self.conn.execute("""SELECT title, favicon, etag, lastmodified, unread FROM feeds WHERE feed=?""", (feed,)).fetchone()
+        """
+        returns the metadata of feed, the icon itself is only referenced by
+        its hash and has to be read with get_favicon
+        """
+        log.debug("get_feed")
+        result = self.conn.execute("""SELECT title, faviconhash, etag, lastmodified, unread, homepage, parser, fallback FROM feeds WHERE feed=?""", (feed,)).fetchone()
         if result:
-            return dict(zip(('title', 'favicon', 'etag', 'lastmodified', 'unread'), result))
+            return dict(zip(('title', 'faviconhash', 'etag', 'lastmodified', 'unread', 'homepage', 'parser', 'fallback'), result))
         else:
             return dict()
 
     def get_entry(self, feed, entry):
-        print "get_entry"
+        log.debug("get_entry")
         result = self.conn.execute("""SELECT title, content, link, date, unread, categories FROM entries WHERE feed=? AND entry=?""", (feed, entry)).fetchone()
         if result:
-            return dict(zip(('title', 'content', 'link', 'date', 'unread', 'categories'), result))
+            result = dict(zip(('title', 'content', 'link', 'date', 'unread', 'categories'), result))
+            result['content'] = decompress_content(result['content'])
+            return result
         else:
             return dict()
 
+    def has_entry(self, feed, entry):
+        return entry in self.known.get(feed)
+
     def get_entries_all(self, feed):
-        print "get_entries_all"
+        log.debug("get_entries_all")
         result = self.conn.execute(
             """SELECT entry, title, date, unread FROM entries WHERE feed=? ORDER BY date DESC""",
             (feed,)).fetchall()
@@ -79,35 +557,417 @@ class SQLStorage():
         else:
             return list()
 
-    def add_entry(self, feed, entry, values):
-        print "add_entry"
-        self.conn.execute("""REPLACE INTO entries (feed, entry, title, content, link, date, unread, categories) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-            (feed, entry, values['title'], values['content'], values['link'], values['date'], values['unread'], values['categories']))
-        self.conn.commit()
+    def count_entries(self, feed):
+        log.debug("count_entries")
+        return self.conn.execute("""SELECT COUNT(*) FROM entries WHERE feed=?""", (feed,)).fetchone()[0]
 
-    def update_feed(self, feed, values):
-        print "update_feed"
-        self.conn.execute("""REPLACE INTO feeds (feed, title, favicon, etag, lastmodified, unread) VALUES (?,?,?,?,?,?)""",
-            (feed, values['title'], values.get('favicon'), values.get('etag'), values.get('lastmodified'), values['unread']))
-        self.conn.commit()
+    def get_entries_page(self, feed, offset, limit):
+        """
+        returns limit entries of feed starting at offset in the order of
+        get_entries_all
+        """
+        log.debug("get_entries_page")
+        # the rowid breaks ties in date and is part of entrydateidx, so this
+        # does not need a temporary b-tree for sorting
+        result = self.conn.execute(
+            """SELECT entry, title, date, unread, starred FROM entries WHERE feed=? ORDER BY date DESC, rowid DESC LIMIT ? OFFSET ?""",
+            (feed, limit, offset)).fetchall()
+        return [dict(zip(('entry', 'title', 'date', 'unread', 'starred'), c)) for c in result]
+
+    def get_entry_positions(self, feed, entries):
+        """
+        returns a sorted list of (position, entry) tuples telling where the
+        given entries are in the order of get_entries_page
+        """
+        log.debug("get_entry_positions")
+        positions = list()
+        for entry in entries:
+            result = self.conn.execute("""SELECT date, rowid FROM entries WHERE feed=? AND entry=?""", (feed, entry)).fetchone()
+            if not result:
+                continue
+            date, rowid = result
+            # walks entrydateidx from the newest entry down to this one
+            position = self.conn.execute(
+                """SELECT COUNT(*) FROM entries WHERE feed=? AND (date>? OR (date=? AND rowid>?))""",
+                (feed, date, date, rowid)).fetchone()[0]
+            positions.append((position, entry))
+        positions.sort()
+        return positions
+
+    def search(self, query, offset=0, limit=100):
+        """
+        returns entries of all feeds matching all words of query, best
+        matches first, paginated by offset and limit
+        """
+        log.debug("search")
+        if not self.fts or not query.split():
+            return list()
+        # matches in the title weigh most, then categories, then content
+        result = self.conn.execute(
+            """SELECT e.feed, e.entry, e.title, e.date, e.unread, e.starred FROM entries_fts JOIN entries e ON e.rowid=entries_fts.rowid
+            WHERE entries_fts MATCH ? ORDER BY bm25(entries_fts, 10.0, 1.0, 5.0) LIMIT ? OFFSET ?""",
+            (fts_query(query), limit, offset)).fetchall()
+        return [dict(zip(('feed', 'entry', 'title', 'date', 'unread', 'starred'), c)) for c in result]
+
+    def count_search(self, query, limit=1000):
+        """
+        returns the number of entries matching query but at most limit
+        """
+        log.debug("count_search")
+        if not self.fts or not query.split():
+            return 0
+        return self.conn.execute(
+            """SELECT COUNT(*) FROM (SELECT 1 FROM entries_fts WHERE entries_fts MATCH ? LIMIT ?)""",
+            (fts_query(query), limit)).fetchone()[0]
+
+    def ingest_feed(self, feed, values, entries, listed=None):
+        """
+        store all new entries of a parsed feed and update the feed row in a
+        single transaction
+        values holds the feed title, homepage, etag, lastmodified, parser
+        and the time of the last fallback from lxml to feedparser
+        and entries is a list of (entry, values) tuples
+        entries that were pruned are not stored again. listed are the ids of
+        all entries in the feed document, if they are known the pruned
+        entries that it does not list anymore are forgotten
+        returns the list of entries that were not in the database before
+        """
+        log.debug("ingest_feed")
+        # skip duplicates within the feed itself, the first one wins
+        pending = dict()
+        order = list()
+        for entry, evalues in entries:
+            if entry not in pending:
+                pending[entry] = evalues
+                order.append(entry)
+        # find out which entries already exist. only those that are not
+        # known are looked up, chunked to stay below the maximum number of
+        # host parameters
+        known = self.known.get(feed)
+        existing = set(e for e in order if e in known)
+        unknown = [e for e in order if e not in known]
+        for i in range(0, len(unknown), 500):
+            chunk = unknown[i:i+500]
+            placeholders = ','.join('?'*len(chunk))
+            existing.update(e for e, in self.conn.execute(
+                """SELECT entry FROM entries WHERE feed=? AND entry IN (%s) UNION ALL SELECT entry FROM pruned WHERE feed=? AND entry IN (%s)"""%(placeholders, placeholders),
+                [feed]+chunk+[feed]+chunk))
+        new = [e for e in order if e not in existing]
+        with self.conn:
+            # the feed row has to exist before the entries so that the
+            # triggers can count the new unread ones
+            self.conn.execute("""INSERT OR IGNORE INTO feeds (feed, unread) VALUES (?, 0)""", (feed,))
+            self.conn.executemany("""INSERT OR IGNORE INTO entries (feed, entry, title, content, link, date, unread, categories) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                ((feed, e, pending[e]['title'], self.store_content(pending[e]['content']), pending[e]['link'], pending[e]['date'], pending[e]['unread'], pending[e]['categories']) for e in new))
+            if self.fts:
+                self.conn.executemany("""INSERT INTO entries_fts (rowid, title, content, categories) SELECT rowid, title, ?, categories FROM entries WHERE feed=? AND entry=?""",
+                    ((strip_html(pending[e]['content']), feed, e) for e in new))
+            self.conn.execute("""UPDATE feeds SET title=?, etag=?, lastmodified=?, homepage=COALESCE(?, homepage), parser=COALESCE(?, parser), fallback=COALESCE(?, fallback) WHERE feed=?""",
+                (values.get('title'), values.get('etag'), values.get('lastmodified'), values.get('homepage'), values.get('parser'), values.get('fallback'), feed))
+            forgotten = 0
+            if listed is not None:
+                listed = set(listed)
+                tombstones = [e for e, in self.conn.execute("""SELECT entry FROM pruned WHERE feed=?""", (feed,))
+                    if e not in listed]
+                self.conn.executemany("""DELETE FROM pruned WHERE feed=? AND entry=?""", ((feed, e) for e in tombstones))
+                forgotten = len(tombstones)
+        if forgotten:
+            self.known.forget(feed)
+        else:
+            self.known.add(feed, unknown)
+        return new
+
+    def get_favicon(self, faviconhash):
+        log.debug("get_favicon")
+        result = self.conn.execute("""SELECT data FROM favicons WHERE hash=?""", (faviconhash,)).fetchone()
+        return str(result[0]) if result else None
+
+    def add_favicon(self, favicon):
+        """
+        store the image data favicon and return its hash or None if there
+        is no data
+        """
+        if not favicon:
+            return None
+        faviconhash = hashlib.sha1(favicon).hexdigest()
+        self.conn.execute("""INSERT OR IGNORE INTO favicons (hash, data) VALUES (?, ?)""", (faviconhash, sqlite3.Binary(favicon)))
+        return faviconhash
+
+    def set_feed_favicon(self, feed, faviconhash):
+        """
+        let feed use the stored icon with hash faviconhash
+        """
+        log.debug("set_feed_favicon")
+        with self.conn:
+            self.conn.execute("""UPDATE feeds SET faviconhash=? WHERE feed=?""", (faviconhash, feed))
+        self.drop_favicons()
 
-    def set_favicon(self, feed, favicon):
-        print "set_favicon"
-        self.conn.execute("""UPDATE feeds SET favicon=? WHERE feed=?""", (favicon, feed))
+    def drop_favicons(self):
+        """
+        delete the icons neither a feed nor a host uses anymore
+        """
+        with self.conn:
+            self.conn.execute("""DELETE FROM favicons WHERE hash NOT IN (SELECT faviconhash FROM feeds WHERE faviconhash IS NOT NULL)
+                AND hash NOT IN (SELECT faviconhash FROM hosticons WHERE faviconhash IS NOT NULL)""")
+
+    def get_host_icon(self, host):
+        log.debug("get_host_icon")
+        result = self.conn.execute("""SELECT iconurl, faviconhash, etag, lastmodified, checked FROM hosticons WHERE host=?""", (host,)).fetchone()
+        if result:
+            return dict(zip(('iconurl', 'faviconhash', 'etag', 'lastmodified', 'checked'), result))
+        else:
+            return dict()
+
+    def set_host_icon(self, host, values):
+        """
+        store the icon of host found at values['iconurl'] with the image
+        data values['data'] and the validators of the response
+        returns the hash of the icon
+        """
+        log.debug("set_host_icon")
+        with self.conn:
+            faviconhash = self.add_favicon(values.get('data'))
+            self.conn.execute("""REPLACE INTO hosticons (host, iconurl, faviconhash, etag, lastmodified, checked) VALUES (?, ?, ?, ?, ?, ?)""",
+                (host, values.get('iconurl'), faviconhash, values.get('etag'), values.get('lastmodified'), int(time.time())))
+        self.drop_favicons()
+        return faviconhash
+
+    def touch_host_icon(self, host):
+        """
+        remember that the icon of host was found to be unchanged just now
+        """
+        log.debug("touch_host_icon")
+        self.conn.execute("""UPDATE hosticons SET checked=? WHERE host=?""", (int(time.time()), host))
         self.conn.commit()
 
     def mark_read(self, feed, entry):
-        print "mark_read"
+        log.debug("mark_read")
+        # the triggers of migration_7 update the counter of the feed
         self.conn.execute("""UPDATE entries SET unread=0 WHERE feed=? AND entry=?""", (feed, entry))
-        self.conn.execute("""UPDATE feeds SET unread=unread-1 WHERE feed=?""", (feed,))
         self.conn.commit()
 
     def mark_read_feed(self, feed):
-        print "mark_read_feed"
-        self.conn.execute("""UPDATE entries SET unread=0 WHERE unread=1""")
-        self.conn.execute("""UPDATE feeds set unread=0 WHERE feed=?""", (feed,))
+        log.debug("mark_read_feed")
+        self.conn.execute("""UPDATE entries SET unread=0 WHERE feed=? AND unread=1""", (feed,))
+        self.conn.commit()
+
+    def get_unread_counts(self):
+        """
+        returns a dictionary mapping all feeds to their number of unread
+        entries
+        """
+        log.debug("get_unread_counts")
+        return dict(self.conn.execute("""SELECT feed, unread FROM feeds"""))
+
+    def get_unread_sum(self, feeds):
+        """
+        returns the number of unread entries of all feeds together
+        """
+        log.debug("get_unread_sum")
+        placeholders = ",".join("?"*len(feeds))
+        result = self.conn.execute("""SELECT SUM(unread) FROM feeds WHERE feed IN (%s)"""%placeholders, list(feeds)).fetchone()
+        return result[0] or 0
+
+    def get_unread_total(self):
+        log.debug("get_unread_total")
+        result = self.conn.execute("""SELECT value FROM counters WHERE name='unread'""").fetchone()
+        return result[0] if result else 0
+
+    def check_unread(self):
+        """
+        check the unread counters without counting entries: no counter may
+        be negative and the counters of all feeds have to add up to the
+        total, which drifts away once entries are counted for feeds without
+        a row or counters are changed behind the back of the triggers
+        returns the list of feeds whose counters have to be recounted, all
+        of them if only the sum is wrong
+        """
+        log.debug("check_unread")
+        counts = self.get_unread_counts()
+        negative = [feed for feed, unread in counts.items() if unread is None or unread < 0]
+        if negative:
+            return negative
+        if sum(counts.values()) != self.get_unread_total():
+            return list(counts)
+        return list()
+
+    def recount_unread(self, feeds):
+        """
+        count the unread entries of feeds again and fix the total
+        this only reads the index over the unread entries
+        """
+        log.debug("recount_unread")
+        with self.conn:
+            self.conn.executemany("""UPDATE feeds SET unread=(SELECT COUNT(*) FROM entries WHERE entries.feed=feeds.feed AND unread=1) WHERE feed=?""",
+                ((feed,) for feed in feeds))
+            self.conn.execute("""INSERT OR REPLACE INTO counters (name, value) SELECT 'unread', COUNT(*) FROM entries WHERE unread=1""")
+
+    def get_archived(self, feed, entry):
+        """
+        returns the path of the archived copy of the link of entry relative
+        to the archive directory or None
+        """
+        log.debug("get_archived")
+        result = self.conn.execute("""SELECT path FROM archive WHERE feed=? AND entry=?""", (feed, entry)).fetchone()
+        return result[0] if result else None
+
+    def get_archived_all(self):
+        """
+        returns the set of paths of all archived copies
+        """
+        log.debug("get_archived_all")
+        return set(path for path, in self.conn.execute("""SELECT path FROM archive"""))
+
+    def set_archived(self, feed, entry, path):
+        log.debug("set_archived")
+        self.conn.execute("""REPLACE INTO archive (feed, entry, path, archived) VALUES (?, ?, ?, ?)""",
+            (feed, entry, path, int(time.time())))
+        self.conn.commit()
+
+    def set_starred(self, feed, entry, starred):
+        log.debug("set_starred")
+        self.conn.execute("""UPDATE entries SET starred=? WHERE feed=? AND entry=?""", (int(starred), feed, entry))
         self.conn.commit()
 
+    def prune_feed(self, feed, keep=None, keepdays=None, batch=200):
+        """
+        delete at most batch of the entries of feed that are neither among
+        the newest keep entries nor younger than keepdays days
+        unread and starred entries are always kept, so the unread counter of
+        the feed stays correct
+        returns the number of deleted entries
+        """
+        log.debug("prune_feed")
+        conditions = list()
+        params = list()
+        if keepdays is not None:
+            conditions.append("""date<?""")
+            params.append(int(time.time()) - keepdays*24*60*60)
+        if keep is not None:
+            # everything from the first entry that is too many on
+            oldest = self.conn.execute("""SELECT date, rowid FROM entries WHERE feed=? ORDER BY date DESC, rowid DESC LIMIT 1 OFFSET ?""",
+                (feed, keep)).fetchone()
+            if oldest:
+                conditions.append("""(date<? OR (date=? AND rowid<=?))""")
+                params.extend((oldest[0], oldest[0], oldest[1]))
+        if not conditions:
+            return 0
+        rowids = [rowid for rowid, in self.conn.execute(
+            """SELECT rowid FROM entries WHERE feed=? AND unread=0 AND starred=0 AND (%s) LIMIT ?"""%' OR '.join(conditions),
+            [feed] + params + [batch])]
+        if not rowids:
+            return 0
+        placeholders = ','.join('?'*len(rowids))
+        with self.conn:
+            # remember the ids as long as the feed lists them
+            self.conn.execute("""INSERT OR IGNORE INTO pruned (feed, entry) SELECT feed, entry FROM entries WHERE rowid IN (%s)"""%placeholders, rowids)
+            if self.fts:
+                self.conn.execute("""DELETE FROM entries_fts WHERE rowid IN (%s)"""%placeholders, rowids)
+            self.conn.execute("""DELETE FROM entries WHERE rowid IN (%s)"""%placeholders, rowids)
+        return len(rowids)
+
+    def prune(self, policies, batch=200):
+        """
+        delete old entries according to policies, a dictionary mapping feeds
+        to (keep, keepdays) tuples as taken by prune_feed
+        this is a generator that deletes at most batch entries per step and
+        yields (feed, number of deleted entries) after each step so that the
+        caller can spread the work
+        """
+        for feed, (keep, keepdays) in policies.items():
+            while True:
+                deleted = self.prune_feed(feed, keep, keepdays, batch)
+                if not deleted:
+                    break
+                # hand the freed pages back to the file system
+                self.conn.execute("""PRAGMA incremental_vacuum(%d)"""%(batch*4)).fetchall()
+                yield feed, deleted
+                if deleted < batch:
+                    break
+
+    def vacuum(self):
+        """
+        rebuild the database file, which switches databases that were
+        created before pruning existed to incremental vacuuming
+        this rewrites the whole file and may take a while
+        """
+        log.debug("vacuum")
+        self.conn.commit()
+        self.conn.execute("""PRAGMA auto_vacuum=INCREMENTAL""")
+        self.conn.execute("""VACUUM""")
+
+    def get_entry_dates(self, feed, limit=20):
+        log.debug("get_entry_dates")
+        return [d for d, in self.conn.execute(
+            """SELECT date FROM entries WHERE feed=? ORDER BY date DESC LIMIT ?""",
+            (feed, limit))]
+
+    def get_schedule(self, feed):
+        log.debug("get_schedule")
+        result = self.conn.execute("""SELECT interval, nextdue, mininterval, skiphours FROM schedule WHERE feed=?""", (feed,)).fetchone()
+        if result:
+            return dict(zip(('interval', 'nextdue', 'mininterval', 'skiphours'), result))
+        else:
+            return dict()
+
+    def get_schedule_all(self):
+        """
+        returns a dictionary mapping feeds to the time they are due next
+        """
+        log.debug("get_schedule_all")
+        return dict(self.conn.execute("""SELECT feed, nextdue FROM schedule"""))
+
+    def set_schedule(self, feed, values):
+        log.debug("set_schedule")
+        self.conn.execute("""REPLACE INTO schedule (feed, interval, nextdue, mininterval, skiphours) VALUES (?,?,?,?,?)""",
+            (feed, values['interval'], values['nextdue'], values['mininterval'], values['skiphours']))
+        self.conn.commit()
+
+    def add_fetch_stats(self, feed, values):
+        log.debug("add_fetch_stats")
+        with self.conn:
+            self.conn.execute("""INSERT INTO fetch_stats (feed, run, status, httpstatus, parser, bytes, dns, connect, wait, transfer, parse, store, new) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                (feed, values['run'], values['status'], values.get('httpstatus'), values.get('parser'), values.get('bytes'),
+                values.get('dns'), values.get('connect'), values.get('wait'), values.get('transfer'), values.get('parse'), values.get('store'), values.get('new')))
+
+    def trim_fetch_stats(self, runs=30):
+        """
+        forget the statistics of all but the last runs refresh runs
+        """
+        log.debug("trim_fetch_stats")
+        with self.conn:
+            self.conn.execute("""DELETE FROM fetch_stats WHERE run NOT IN (SELECT DISTINCT run FROM fetch_stats ORDER BY run DESC LIMIT ?)""", (runs,))
+
+    def get_run_stats(self, run=None):
+        """
+        returns the totals of the refresh run started at run, by default of
+        the last one, or an empty dictionary if there is none
+        """
+        log.debug("get_run_stats")
+        if run is None:
+            run, = self.conn.execute("""SELECT MAX(run) FROM fetch_stats""").fetchone()
+            if run is None:
+                return dict()
+        keys = ('feeds', 'notmodified', 'errors', 'bytes', 'dns', 'connect', 'wait', 'transfer', 'parse', 'store', 'new')
+        result = self.conn.execute("""SELECT COUNT(*), SUM(httpstatus=304), SUM(status IN ('error', 'invalid')),
+            TOTAL(bytes), TOTAL(dns), TOTAL(connect), TOTAL(wait), TOTAL(transfer), TOTAL(parse), TOTAL(store), TOTAL(new)
+            FROM fetch_stats WHERE run=?""", (run,)).fetchone()
+        values = dict(zip(keys, result))
+        values['run'] = run
+        return values
+
+    def get_feed_stats(self):
+        """
+        returns a list of dictionaries with the averages of each feed over
+        all kept runs, the feeds that take longest first
+        """
+        log.debug("get_feed_stats")
+        keys = ('feed', 'fetches', 'notmodified', 'errors', 'bytes', 'dns', 'connect', 'wait', 'transfer', 'parse', 'store', 'new')
+        return [dict(zip(keys, row)) for row in self.conn.execute("""SELECT feed, COUNT(*), SUM(httpstatus=304), SUM(status IN ('error', 'invalid')),
+            AVG(bytes), AVG(dns), AVG(connect), AVG(wait), AVG(transfer), AVG(parse), AVG(store), TOTAL(new)
+            FROM fetch_stats GROUP BY feed
+            ORDER BY TOTAL(dns)+TOTAL(connect)+TOTAL(wait)+TOTAL(transfer)+TOTAL(parse)+TOTAL(store) DESC""")]
+
     def close(self):
         self.conn.close()
 
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# parse_lxml has to store the same entries that feedparser would, checked
+# with the comparison of python feedworker.py on the documents in data/.
+
+import unittest
+import os
+import feedworker
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+class ParityTest(unittest.TestCase):
+    def check(self, filename):
+        with open(os.path.join(DATA, filename)) as f:
+            data = f.read()
+        baseuri = "http://example.com/feed"
+        fast = feedworker.parse_lxml(data, baseuri)
+        reference = feedworker.parse_feedparser(data, baseuri)
+        self.assertTrue(fast)
+        self.assertTrue(reference)
+        self.assertEqual(feedworker.compare(fast, reference, baseuri), [])
+
+    def test_atom_content(self):
+        self.check("content.atom")
+
+if __name__ == "__main__":
+    unittest.main()
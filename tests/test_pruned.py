@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# entries that were pruned must not come back as new unread entries while
+# the feed document still lists them, whichever parser read the document.
+# run with python -m unittest discover -s tests -t .
+
+import unittest
+import feedworker
+import sqlite_db
+
+FEED = "http://example.com/feed"
+
+def document(count):
+    """
+    an rss feed of count entries, the newest first
+    """
+    return """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>feed</title><link>http://example.com/</link>
+%s
+</channel></rss>"""%"\n".join("""<item><title>entry %d</title><guid>e%d</guid>
+<pubDate>Mon, %02d Jan 2018 12:00:00 GMT</pubDate><description>text %d</description></item>"""%(
+        n, n, 20-n, n) for n in range(count))
+
+class PrunedTest(unittest.TestCase):
+    def setUp(self):
+        self.feeddb = sqlite_db.SQLStorage()
+        self.feeddb.ingest_feed(FEED, {'title': "feed"}, feedworker.parse_feed(document(8))['entries'])
+        self.feeddb.mark_read_feed(FEED)
+        self.assertEqual(sum(deleted for feed, deleted in self.feeddb.prune({FEED: (3, None)})), 5)
+
+    def tombstones(self):
+        return self.feeddb.conn.execute("""SELECT COUNT(*) FROM pruned WHERE feed=?""", (FEED,)).fetchone()[0]
+
+    def fetch_stream(self, data, stop_after=0):
+        """
+        what FeedUpdater does with a feed that it parses while downloading
+        """
+        stream = feedworker.StreamParser(FEED, lambda itemid: self.feeddb.has_entry(FEED, itemid), stop_after)
+        stream.feed(data)
+        result = feedworker.normalize_stream(stream.close(), FEED)
+        return self.feeddb.ingest_feed(FEED, {'title': result['title']}, result['entries'], listed=result['ids'])
+
+    def fetch(self, data):
+        """
+        what FeedUpdater does with a feed that goes to the worker pool
+        """
+        result = feedworker.parse_feed(data, FEED, 'feedparser')
+        return self.feeddb.ingest_feed(FEED, {'title': result['title']}, result['entries'], listed=result['ids'])
+
+    def test_stream_keeps_tombstones(self):
+        self.assertEqual(self.fetch_stream(document(8)), [])
+        self.assertEqual(self.tombstones(), 5)
+        self.assertEqual(self.fetch_stream(document(8)), [])
+        self.assertEqual(self.fetch(document(8)), [])
+        self.assertEqual(self.feeddb.get_unread_total(), 0)
+
+    def test_stopped_stream_keeps_tombstones(self):
+        self.assertEqual(self.fetch_stream(document(8), stop_after=2), [])
+        self.assertEqual(self.tombstones(), 5)
+        self.assertEqual(self.fetch_stream(document(8)), [])
+
+    def test_tombstones_are_forgotten(self):
+        # the feed does not list e5 to e7 anymore
+        self.assertEqual(self.fetch_stream(document(5)), [])
+        self.assertEqual(self.tombstones(), 2)
+        self.assertEqual(self.fetch(document(4)), [])
+        self.assertEqual(self.tombstones(), 1)
+        self.assertEqual(self.fetch_stream(document(4)), [])
+        self.assertEqual(self.feeddb.get_unread_total(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Johannes 'josch' Schauer <j.schauer@email.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# the userscripts executed in the content pane after a page loaded. they are
+# read once and reloaded when they change on disk, and run only on the pages
+# that their ==UserScript== header asks for.
+
+from gi.repository import Gio
+import fnmatch
+import logging
+import os
+import re
+
+log = logging.getLogger(__name__)
+
+
+def parse_header(source):
+    """
+    returns a dictionary mapping the keys of the ==UserScript== block of
+    source to the lists of their values
+    """
+    header = dict()
+    match = re.search(r'==UserScript==(.*?)==/UserScript==', source, re.S)
+    if not match:
+        return header
+    for key, value in re.findall(r'^\s*//\s*@(\S+)[ \t]*(.*?)\s*$', match.group(1), re.M):
+        header.setdefault(key, list()).append(value)
+    return header
+
+def include_to_regex(pattern):
+    """
+    turn an @include or @exclude pattern, which is either a glob or a
+    regular expression between slashes, into a regular expression
+    """
+    if len(pattern) > 2 and pattern.startswith('/') and pattern.endswith('/'):
+        return pattern[1:-1]
+    # .tld matches any top level domain
+    return fnmatch.translate(pattern).replace(r'\.tld', r'\.[a-z.]+')
+
+def match_to_regex(pattern):
+    """
+    turn a @match pattern of the form scheme://host/path into a regular
+    expression
+    """
+    if pattern == '<all_urls>':
+        return r'(https?|ftp|file)://.*'
+    match = re.match(r'^(\*|[a-z]+)://(\*|\*\.[^/*]+|[^/*]*)(/.*)$', pattern)
+    if not match:
+        # invalid patterns match nothing
+        return r'(?!)'
+    scheme, host, path = match.groups()
+    if scheme == '*':
+        scheme = r'https?'
+    if host == '*':
+        host = r'[^/]*'
+    elif host.startswith('*.'):
+        host = r'([^/]*\.)?' + re.escape(host[2:])
+    else:
+        host = re.escape(host)
+    path = '.*'.join(re.escape(part) for part in path.split('*'))
+    return scheme + '://' + host + r'(:\d+)?' + path + '$'
+
+class UserScript():
+    """
+    a userscript read from path with its url patterns compiled
+    scripts without @include or @match run on all pages
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path) as f:
+            self.source = f.read()
+        header = parse_header(self.source)
+        self.name = (header.get('name') or [os.path.basename(path)])[0]
+        includes = [include_to_regex(p) for p in header.get('include', [])]
+        includes += [match_to_regex(p) for p in header.get('match', [])]
+        excludes = [include_to_regex(p) for p in header.get('exclude', [])]
+        self.include = re.compile('|'.join('(?:%s)'%p for p in includes), re.I) if includes else None
+        self.exclude = re.compile('|'.join('(?:%s)'%p for p in excludes), re.I) if excludes else None
+
+    def matches(self, url):
+        if self.exclude and self.exclude.match(url):
+            return False
+        return not self.include or self.include.match(url) is not None
+
+class ScriptRegistry():
+    """
+    keeps the .js files of the given directories in memory and watches the
+    directories for changes
+    """
+    def __init__(self, dirs):
+        # path -> UserScript
+        self.scripts = dict()
+        # the monitors stop watching once they are garbage collected
+        self.monitors = list()
+        for path in dirs:
+            if not os.path.isdir(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                self.load(os.path.join(path, name))
+            monitor = Gio.File.new_for_path(path).monitor_directory(Gio.FileMonitorFlags.NONE, None)
+            monitor.connect("changed", self.changed_cb)
+            self.monitors.append(monitor)
+
+    def load(self, path):
+        """
+        (re)load the script at path or forget it if it is gone
+        """
+        if not path.endswith(".js"):
+            return
+        if not os.path.isfile(path):
+            self.scripts.pop(path, None)
+            return
+        try:
+            self.scripts[path] = UserScript(path)
+        except (IOError, re.error) as e:
+            log.warning("cannot load userscript %s: %s", path, e)
+            self.scripts.pop(path, None)
+
+    def changed_cb(self, monitor, f, other, event):
+        if event in [Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.DELETED]:
+            self.load(f.get_path())
+
+    def scripts_for(self, url):
+        """
+        returns the sources of all scripts that want to run on url
+        """
+        if not url:
+            return list()
+        return [self.scripts[path].source for path in sorted(self.scripts)
+            if self.scripts[path].matches(url)]
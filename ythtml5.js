@@ -1,3 +1,9 @@
+// ==UserScript==
+// @name        ythtml5
+// @include     http://*
+// @include     https://*
+// ==/UserScript==
+
 /*
  * inspired by http://userscripts.org/scripts/show/116935
  * by http://userscripts.org/users/miguillo